@@ -3,7 +3,12 @@ create table tg_groups (
   name text not null,
   pub_id text,
   loaded_first_id bigint,
-  loaded_last_id bigint
+  loaded_last_id bigint,
+  -- how to reach the group without resolving it again; the access hash is
+  -- only valid for the account access_user_id. For existing databases:
+  -- alter table tg_groups add column access_hash bigint, add column access_user_id bigint;
+  access_hash bigint,
+  access_user_id bigint
 );
 
 create table messages (
@@ -33,7 +38,8 @@ EXCEPTION
 END;
 $$ LANGUAGE plpgsql;
 
--- initialize historical partition tables
+-- initialize historical partition tables; luoxu creates partitions for the
+-- current and upcoming periods itself (see partition_granularity)
 CREATE OR REPLACE FUNCTION init_message_partitions()
 RETURNS void AS $$
 DECLARE
@@ -80,7 +86,16 @@ create unique index messages_msgid_idx on messages (group_id, msgid, created_at
 --   Options: Inlining false, Optimization false, Expressions true, Deforming true
 --   Timing: Generation 0.896 ms, Inlining 0.000 ms, Optimization 0.536 ms, Emission 8.271 ms, Total 9.703 ms
 -- Execution Time: 68.963 ms
-CREATE INDEX message_idx ON messages USING pgroonga (text) WITH (tokenizer='TokenNgram("report_source_location", true, "loose_blank", true)');
+-- the text-only index used before message_group_idx; existing databases
+-- still have it until `python -m luoxu.build_index --drop-old` replaces it:
+-- CREATE INDEX message_idx ON messages USING pgroonga (text) WITH (tokenizer='TokenNgram("report_source_location", true, "loose_blank", true)');
+
+-- group-aware fulltext search: group_id and created_at conditions are
+-- evaluated by the pgroonga index scan instead of filtering matches of all
+-- groups on the heap; it serves searches without a group too. On an
+-- existing database, build it partition by partition with
+-- `python -m luoxu.build_index --drop-old`.
+CREATE INDEX message_group_idx ON messages USING pgroonga (text, group_id, created_at) WITH (tokenizer='TokenNgram("report_source_location", true, "loose_blank", true)');
 
 -- message by sender without search terms
 --
@@ -88,6 +103,99 @@ CREATE INDEX message_idx ON messages USING pgroonga (text) WITH (tokenizer='Toke
 -- explain analyze select msgid, group_id, from_user, from_user_name, created_at, updated_at, text from messages where 1 = 1 and group_id = 1031857103 and from_user = 694598748 order by created_at desc limit 50;
 -- CREATE INDEX message_sender_idx ON public.messages USING btree (from_user, created_at DESC);
 
+-- progress of parallel backfill (telegram.backfill_workers); messages with
+-- ids in [cursor, range_end) have been indexed
+create table backfill_ranges (
+  group_id bigint not null references tg_groups (group_id),
+  range_start bigint not null,
+  range_end bigint not null,
+  cursor bigint not null,
+  primary key (group_id, range_start)
+);
+
+-- message id ranges that have been indexed, used when track_gaps is set;
+-- ids inside [loaded_first_id, loaded_last_id] not covered are gaps
+create table loaded_ranges (
+  group_id bigint not null references tg_groups (group_id),
+  first_id bigint not null,
+  last_id bigint not null,
+  primary key (group_id, first_id)
+);
+
+-- OCR results by photo / document id, used when ocr_persist is set
+create table ocr_results (
+  media_id bigint primary key,
+  engine text not null,
+  result text[] not null,
+  -- difference hash of the smallest thumbnail, for ocr_dedup_distance
+  phash bigint,
+  created_at timestamp with time zone not null default now()
+);
+-- ocr_dedup_distance looks up similar hashes by each 16-bit block
+create index ocr_results_phash0_idx on ocr_results ((phash & 65535)) where phash is not null;
+create index ocr_results_phash1_idx on ocr_results (((phash >> 16) & 65535)) where phash is not null;
+create index ocr_results_phash2_idx on ocr_results (((phash >> 32) & 65535)) where phash is not null;
+create index ocr_results_phash3_idx on ocr_results (((phash >> 48) & 65535)) where phash is not null;
+
+-- images waiting for OCR, used when ocr_workers is set
+create table ocr_jobs (
+  group_id bigint not null,
+  msgid bigint not null,
+  created_at timestamp with time zone not null,
+  tries int not null default 0,
+  next_try timestamp with time zone not null default now(),
+  last_error text,
+  primary key (group_id, msgid)
+);
+
+create index ocr_jobs_next_try_idx on ocr_jobs (next_try);
+
+-- per-day word counts for the wordcloud plugin, maintained by
+-- `luoxu-cutwords --aggregate` and used with `--use-aggregates`. Days are in
+-- UTC; from_user 0 is all users.
+create table wordcount_words (
+  group_id bigint not null,
+  day date not null,
+  from_user bigint not null,
+  word text not null,
+  count int not null,
+  primary key (group_id, day, from_user, word)
+);
+
+create index wordcount_words_user_idx on wordcount_words (group_id, from_user, day);
+
+create table wordcount_messages (
+  group_id bigint not null,
+  day date not null,
+  from_user bigint not null,
+  messages int not null,
+  primary key (group_id, day, from_user)
+);
+
+-- days whose messages changed after they were aggregated; rows are only
+-- appended here so that concurrent ingest never waits on each other
+create table wordcount_dirty (
+  id bigserial primary key,
+  group_id bigint not null,
+  day date not null
+);
+
+CREATE OR REPLACE FUNCTION mark_wordcount_dirty()
+RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO wordcount_dirty (group_id, day)
+    VALUES (NEW.group_id, (NEW.created_at AT TIME ZONE 'UTC')::date);
+  RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+-- only create the trigger if `luoxu-cutwords --aggregate` will be running,
+-- or wordcount_dirty keeps growing; then mark existing messages:
+-- CREATE TRIGGER wordcount_dirty AFTER INSERT OR UPDATE OF text
+--   ON messages FOR EACH ROW EXECUTE PROCEDURE mark_wordcount_dirty();
+-- INSERT INTO wordcount_dirty (group_id, day)
+--   SELECT DISTINCT group_id, (created_at AT TIME ZONE 'UTC')::date FROM messages;
+
 create table usernames (
   name text not null,
   uid bigint[] not null,
@@ -0,0 +1,136 @@
+//! Splitting a time range into whole UTC days that may be read from per-day
+//! aggregates and parts that have to be counted from messages.
+//!
+//! Days are numbered from 1970-01-01, as in (day - date '1970-01-01') in SQL.
+
+pub const DAY: u64 = 86400;
+
+#[derive(Debug, PartialEq)]
+pub struct Plan {
+  /// aggregates of days in [first_day, today) except dirty ones are summed
+  pub first_day: i32,
+  pub today: i32,
+  /// time ranges [since, until) to count from messages
+  pub scan: Vec<(u64, u64)>,
+}
+
+/// the whole days [first_day, today) in [since, until), before `now`'s day
+pub fn whole_days(since: u64, until: u64, now: u64) -> (i32, i32) {
+  (since.div_ceil(DAY) as i32, (until.min(now) / DAY) as i32)
+}
+
+/// Plan counting [since, until) at time `now`, given the days in
+/// [first_day, today) whose aggregates are outdated. `None` if there is no
+/// whole day to use aggregates for.
+pub fn plan(since: u64, until: u64, now: u64, dirty: &[i32]) -> Option<Plan> {
+  let (first_day, today) = whole_days(since, until, now);
+  if first_day >= today {
+    return None;
+  }
+
+  let mut scan = vec![(since, first_day as u64 * DAY)];
+  scan.extend(dirty.iter().map(|&d| (d as u64 * DAY, (d + 1) as u64 * DAY)));
+  scan.push((today as u64 * DAY, until));
+  scan.retain(|(since, until)| since < until);
+  Some(Plan { first_day, today, scan })
+}
+
+#[cfg(test)]
+mod tests {
+  use std::collections::{HashMap, HashSet};
+
+  use super::*;
+
+  /// (time, word) pairs, several per day over ten days
+  fn messages() -> Vec<(u64, &'static str)> {
+    let words = ["a", "b", "c", "d", "e"];
+    (0..10 * 24)
+      .map(|h| (100 * DAY + h * 3600 + 17, words[(h * 7 % 5) as usize]))
+      .collect()
+  }
+
+  fn recount(msgs: &[(u64, &str)], since: u64, until: u64) -> HashMap<String, u64> {
+    let mut r = HashMap::new();
+    for &(t, w) in msgs {
+      if t >= since && t < until {
+        *r.entry(w.to_string()).or_insert(0) += 1;
+      }
+    }
+    r
+  }
+
+  /// what aggregate::count does, with aggregates of dirty days stale
+  fn count_with_aggregates(
+    msgs: &[(u64, &str)], since: u64, until: u64, now: u64, dirty: &[i32],
+  ) -> HashMap<String, u64> {
+    let Some(p) = plan(since, until, now, dirty) else {
+      return recount(msgs, since, until);
+    };
+    let dirty_set: HashSet<i32> = dirty.iter().copied().collect();
+    let mut r = HashMap::new();
+    for day in p.first_day..p.today {
+      if dirty_set.contains(&day) {
+        // stale aggregates must not be used
+        *r.entry("stale".to_string()).or_insert(0) += 1000;
+        continue;
+      }
+      let start = day as u64 * DAY;
+      for (w, n) in recount(msgs, start, start + DAY) {
+        *r.entry(w).or_insert(0) += n;
+      }
+    }
+    for (s, u) in p.scan {
+      for (w, n) in recount(msgs, s, u) {
+        *r.entry(w).or_insert(0) += n;
+      }
+    }
+    r.remove("stale");
+    r
+  }
+
+  #[test]
+  fn mid_day_range_equals_recount() {
+    let msgs = messages();
+    let since = 101 * DAY + 5 * 3600 + 123;
+    let until = 108 * DAY + 20 * 3600 + 7;
+    let now = 200 * DAY;
+    for dirty in [&[][..], &[103], &[102, 105, 107], &[101]] {
+      let dirty: Vec<i32> = dirty.iter().copied()
+        .filter(|&d| d >= since.div_ceil(DAY) as i32 && d < (until / DAY) as i32)
+        .collect();
+      assert_eq!(
+        count_with_aggregates(&msgs, since, until, now, &dirty),
+        recount(&msgs, since, until),
+        "dirty days {:?}", dirty,
+      );
+    }
+  }
+
+  #[test]
+  fn today_is_scanned() {
+    let msgs = messages();
+    let since = 100 * DAY + 1;
+    let until = 300 * DAY;
+    let now = 107 * DAY + 10 * 3600;
+    let p = plan(since, until, now, &[]).unwrap();
+    assert_eq!((p.first_day, p.today), (101, 107));
+    assert_eq!(p.scan, vec![(since, 101 * DAY), (107 * DAY, until)]);
+    assert_eq!(
+      count_with_aggregates(&msgs, since, until, now, &[]),
+      recount(&msgs, since, until),
+    );
+  }
+
+  #[test]
+  fn whole_days_only() {
+    let p = plan(101 * DAY, 104 * DAY, 200 * DAY, &[102]).unwrap();
+    assert_eq!((p.first_day, p.today), (101, 104));
+    assert_eq!(p.scan, vec![(102 * DAY, 103 * DAY)]);
+  }
+
+  #[test]
+  fn within_one_day() {
+    assert_eq!(plan(101 * DAY + 1, 102 * DAY + 5, 200 * DAY, &[]), None);
+    assert_eq!(plan(101 * DAY + 1, 101 * DAY + 5, 200 * DAY, &[]), None);
+  }
+}
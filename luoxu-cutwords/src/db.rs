@@ -1,130 +1,145 @@
-use std::mem::swap;
+use std::sync::mpsc::SyncSender;
 use std::time;
 
 use eyre::Result;
 use tracing::info;
-use postgres::{Client, Statement};
+use postgres::Client;
 
-struct Message {
-  msgid: i64,
-  text: String,
-}
-
-pub struct MessageIter {
-  client: Client,
-  statement: Statement,
-  errored: bool,
-  done: bool,
+const BATCH_SIZE: i32 = 1000;
 
-  rows: Vec<Message>,
-  last_idx: usize,
-  last_msgid: i64,
+pub type Batch = Result<Vec<String>>;
 
-  group_id: i64,
-  endtime: time::SystemTime,
-  user_id: Option<i64>,
+/// messages of a group (and optionally a user) in [since, until)
+pub struct MessageQuery {
+  pub group_id: i64,
+  pub since: u64,
+  pub until: u64,
+  pub user_id: Option<i64>,
 }
 
-impl MessageIter {
-  pub fn new(
-    mut client: Client,
-    group_id: i64, endtime: u64, user_id: Option<i64>,
-  ) -> Result<Self> {
-    let statement = client.prepare(
-      match user_id {
-        Some(_) => r"
-          SELECT msgid, text FROM messages
-          WHERE msgid < $1
-            and group_id = $2
-            and created_at > $3
-            and from_user = $4
-          ORDER BY msgid DESC LIMIT 1000
-        ",
-        None => r"
-          SELECT msgid, text FROM messages
-          WHERE msgid < $1
-            and group_id = $2
-            and created_at > $3
-          ORDER BY msgid DESC LIMIT 1000
-        ",
+impl MessageQuery {
+  /// Send texts of the messages in batches until all are sent or the
+  /// receiver goes away.
+  ///
+  /// Rows are read from a portal (server-side cursor) in no particular
+  /// order, and the time bounds let PostgreSQL skip partitions outside them.
+  pub fn stream(&self, client: &mut Client, tx: &SyncSender<Batch>) -> Result<()> {
+    let since = time::SystemTime::UNIX_EPOCH + time::Duration::from_secs(self.since);
+    let until = time::SystemTime::UNIX_EPOCH + time::Duration::from_secs(self.until);
+
+    let mut transaction = client.transaction()?;
+    info!("query database for messages");
+    let portal = match self.user_id {
+      Some(uid) => transaction.bind(r"
+        SELECT text FROM messages
+        WHERE group_id = $1
+          and created_at >= $2
+          and created_at < $3
+          and from_user = $4
+      ", &[&self.group_id, &since, &until, &uid])?,
+      None => transaction.bind(r"
+        SELECT text FROM messages
+        WHERE group_id = $1
+          and created_at >= $2
+          and created_at < $3
+      ", &[&self.group_id, &since, &until])?,
+    };
+
+    loop {
+      let rows = transaction.query_portal(&portal, BATCH_SIZE)?;
+      let done = rows.len() < BATCH_SIZE as usize;
+      let texts: Vec<String> = rows.into_iter().map(|row| row.get(0)).collect();
+      if tx.send(Ok(texts)).is_err() || done {
+        break;
       }
-    )?;
-    Ok(MessageIter {
-      client,
-      statement,
-      errored: false,
-      done: false,
-
-      rows: Vec::new(),
-      last_idx: 0,
-      last_msgid: i64::MAX,
-
-      group_id,
-      endtime: time::SystemTime::UNIX_EPOCH + time::Duration::from_secs(endtime),
-      user_id,
-    })
+    }
+    Ok(())
   }
 }
 
-impl Iterator for MessageIter {
-  type Item = Result<String>;
+/// These need a PostgreSQL database to write temporary tables in, e.g.
+/// `LUOXU_TEST_DB=postgresql:///test cargo test -- --ignored`.
+#[cfg(test)]
+mod tests {
+  use std::sync::mpsc;
 
-  fn next(&mut self) -> Option<Self::Item> {
-    if self.errored {
-      return None;
-    }
+  use postgres::NoTls;
 
-    if self.last_idx == self.rows.len() {
-      if self.done {
-        return None;
-      }
+  use super::*;
 
-      info!("query database for messages");
-      let rows = match self.user_id {
-        Some(uid) => self.client.query(
-          &self.statement,
-          &[
-            &self.last_msgid,
-            &self.group_id,
-            &self.endtime,
-            &uid,
-          ],
-        ),
-        None => self.client.query(
-          &self.statement,
-          &[
-            &self.last_msgid,
-            &self.group_id,
-            &self.endtime,
-          ],
-        ),
-      };
-
-      if let Err(e) = rows {
-        self.errored = true;
-        return Some(Err(e.into()));
-      }
-      let rows = rows.unwrap();
-
-      let messages: Vec<Message> = rows.iter().map(|row| Message {
-        msgid: row.get(0),
-        text: row.get(1),
-      }).collect();
-      if messages.len() < 1000 {
-        self.done = true;
-      }
-      self.last_idx = 0;
-      self.rows = messages;
-      if self.rows.is_empty() {
-        return None;
-      } else {
-        self.last_msgid = self.rows[self.rows.len()-1].msgid;
-      }
-    }
+  const DAY: u64 = 86400;
+
+  fn connect() -> Client {
+    let dbstring = std::env::var("LUOXU_TEST_DB").expect("LUOXU_TEST_DB not set");
+    let mut client = Client::connect(&dbstring, NoTls).unwrap();
+    // shadows any real messages table for this connection only
+    client.batch_execute(r"
+      CREATE TEMP TABLE messages (
+        group_id bigint not null,
+        from_user bigint,
+        text text not null,
+        created_at timestamp with time zone not null
+      )
+    ").unwrap();
+    client
+  }
+
+  /// n messages of group 1 by user (i % 2), one per second from day 10
+  fn insert(client: &mut Client, n: i64) {
+    client.execute(r"
+      INSERT INTO messages
+      SELECT 1, i % 2, 'msg ' || i, to_timestamp(864000 + i)
+      FROM generate_series(0, $1::int8 - 1) AS i
+    ", &[&n]).unwrap();
+    // other groups and outside the time range
+    client.execute(r"
+      INSERT INTO messages VALUES
+        (2, 0, 'other group', to_timestamp(864000)),
+        (1, 0, 'too early', to_timestamp(863999)),
+        (1, 0, 'too late', to_timestamp(950400))
+    ", &[]).unwrap();
+  }
+
+  fn collect(client: &mut Client, q: &MessageQuery) -> Vec<usize> {
+    let (tx, rx) = mpsc::sync_channel(1000);
+    q.stream(client, &tx).unwrap();
+    drop(tx);
+    rx.into_iter().map(|b| b.unwrap().len()).collect()
+  }
+
+  #[test]
+  #[ignore]
+  fn batches_cover_all_rows() {
+    let mut client = connect();
+    insert(&mut client, 2500);
+    let q = MessageQuery { group_id: 1, since: 10 * DAY, until: 11 * DAY, user_id: None };
+    assert_eq!(collect(&mut client, &q), vec![1000, 1000, 500]);
+
+    let q = MessageQuery { user_id: Some(1), ..q };
+    assert_eq!(collect(&mut client, &q), vec![1000, 250]);
+  }
+
+  #[test]
+  #[ignore]
+  fn exact_multiple_of_batch_size() {
+    let mut client = connect();
+    insert(&mut client, 2000);
+    let q = MessageQuery { group_id: 1, since: 10 * DAY, until: 11 * DAY, user_id: None };
+    let batches = collect(&mut client, &q);
+    assert_eq!(batches.iter().sum::<usize>(), 2000);
+    assert!(batches.iter().all(|&n| n <= BATCH_SIZE as usize));
+  }
 
-    let mut ret = String::new();
-    swap(&mut self.rows[self.last_idx].text, &mut ret);
-    self.last_idx += 1;
-    Some(Ok(ret))
+  #[test]
+  #[ignore]
+  fn stops_when_receiver_is_gone() {
+    let mut client = connect();
+    insert(&mut client, 5000);
+    let q = MessageQuery { group_id: 1, since: 10 * DAY, until: 11 * DAY, user_id: None };
+    let (tx, rx) = mpsc::sync_channel(1);
+    drop(rx);
+    q.stream(&mut client, &tx).unwrap();
+    // the connection is still usable
+    client.query_one("SELECT 1", &[]).unwrap();
   }
 }
@@ -0,0 +1,235 @@
+use std::fs::File;
+use std::io::{BufReader, BufRead};
+use std::collections::HashSet;
+use std::sync::mpsc::{self, SyncSender};
+use std::thread;
+
+use eyre::{Result, eyre};
+use tracing::{info, warn};
+use jieba_rs::Jieba;
+use rayon::prelude::*;
+
+use crate::db::Batch;
+use crate::filter::{skip_message, stops_message, keep_tagged};
+pub use crate::wordcount::WordCount;
+
+// batches read ahead of tokenization
+const QUEUE_SIZE: usize = 16;
+
+pub struct Engine {
+  jieba: Jieba,
+  stop_words: HashSet<String>,
+}
+
+impl Engine {
+  pub fn new() -> Self {
+    info!("loading jieba");
+    let mut jieba = Jieba::new();
+    if let Err(e) = load_dict(&mut jieba) {
+      warn!("failed to load userdict.txt: {:#}", e);
+    }
+    let stop_words = match load_stopwords() {
+      Ok(s) => s,
+      Err(e) => {
+        warn!("failed to load StopWords-simple.txt: {:#}", e);
+        HashSet::new()
+      },
+    };
+    Engine { jieba, stop_words }
+  }
+
+  /// Count words of messages that `reader` sends from another thread.
+  ///
+  /// Batches are tokenized in parallel on the rayon thread pool; each worker
+  /// counts into its own map and the maps are merged at the end.
+  pub fn count<R>(&self, reader: R) -> Result<WordCount>
+  where R: FnOnce(&SyncSender<Batch>) -> Result<()> + Send
+  {
+    info!("Processing messages");
+    let (tx, rx) = mpsc::sync_channel(QUEUE_SIZE);
+    thread::scope(|s| {
+      s.spawn(move || {
+        if let Err(e) = reader(&tx) {
+          let _ = tx.send(Err(e));
+        }
+      });
+
+      // the receiver is dropped when this returns, stopping the reader early
+      // on errors
+      rx.into_iter().par_bridge().try_fold(
+        WordCount::default,
+        |mut wc: WordCount, batch: Batch| -> Result<WordCount> {
+          let mut words = Vec::new();
+          for msg in batch? {
+            words.clear();
+            self.cut(&msg, &mut words);
+            wc.add(&words);
+          }
+          Ok(wc)
+        },
+      ).try_reduce(
+        WordCount::default,
+        |mut a: WordCount, b: WordCount| -> Result<WordCount> {
+          a.merge(b);
+          Ok(a)
+        },
+      )
+    })
+  }
+
+  /// append the words of a message we're interested in to `words`
+  pub fn cut(&self, msg: &str, words: &mut Vec<String>) {
+    if skip_message(msg) {
+      return;
+    }
+    for line in msg.split('\n') {
+      if stops_message(line) {
+        return;
+      }
+      for tag in self.jieba.tag(line, true) {
+        if !keep_tagged(tag.word, tag.tag) {
+          continue;
+        }
+        let word = tag.word.to_lowercase();
+        if self.stop_words.contains(&word) {
+          continue;
+        }
+        words.push(word);
+      }
+    }
+  }
+}
+
+fn load_dict(jieba: &mut Jieba) -> Result<()> {
+  let mut f = BufReader::new(File::open("userdict.txt")?);
+  let mut buf = String::new();
+  while f.read_line(&mut buf)? > 0 {
+    let mut it = buf.split_whitespace();
+    let word = it.next().ok_or_else(|| eyre!("bad dict line: {}", buf))?;
+    let tag = Some(it.next().ok_or_else(|| eyre!("bad dict line: {}", buf))?);
+    jieba.add_word(word, None, tag);
+    buf.clear();
+  }
+  Ok(())
+}
+
+fn load_stopwords() -> Result<HashSet<String>> {
+  let f = BufReader::new(File::open("StopWords-simple.txt")?);
+  let mut set = HashSet::new();
+  for line in f.lines() {
+    let line = line?;
+    set.insert(line);
+  }
+  Ok(set)
+}
+
+#[cfg(test)]
+mod tests {
+  use std::collections::HashMap;
+
+  use super::*;
+
+  /// the counting loop of luoxu-cutwords before the engine was split out
+  fn old_count(engine: &Engine, msgs: &[&str]) -> (usize, HashMap<String, u64>) {
+    const STOP_FLAGS: &[&str] = &[
+      "d", "f", "x", "p", "t", "q", "m", "nr", "r", "c", "e", "xc", "zg", "y",
+      "uj", "ug", "ul", "ud",
+    ];
+    let mut count = 0;
+    let mut result = HashMap::new();
+    'nextmsg: for msg in msgs {
+      count += 1;
+      if msg.is_empty() {
+        continue;
+      }
+      if msg.starts_with("/luoxucloud") {
+        continue;
+      }
+      if msg.starts_with("落絮词云为您生成消息词云") {
+        continue;
+      }
+      if msg.starts_with("落絮词云未找到符合条件的消息") {
+        continue;
+      }
+      if msg.starts_with("[Lisa] ") {
+        continue;
+      }
+      for line in msg.split('\n') {
+        for pat in ["[webpage]", "[poll]", "[file]", "[audio]"] {
+          if line.starts_with(pat) {
+            continue 'nextmsg;
+          }
+        }
+        for tag in engine.jieba.tag(line, true) {
+          if STOP_FLAGS.contains(&tag.tag) || tag.word.len() > 21 {
+            continue;
+          }
+          let word = tag.word.to_lowercase();
+          if engine.stop_words.contains(&word) {
+            continue;
+          }
+          *result.entry(word).or_insert(0) += 1;
+        }
+      }
+    }
+    (count, result)
+  }
+
+  const MESSAGES: &[&str] = &[
+    "今天天气真好，我们去公园散步吧",
+    "",
+    "/luoxucloud 7",
+    "落絮词云为您生成消息词云\n某群组",
+    "[Lisa] 自动回复",
+    "看看这个链接\n[webpage] 标题 https://example.com\n之后的内容不算",
+    "[poll] 投票\n选项一\n选项二",
+    "Rust 和 Python 都很好用，Rust 更快",
+    "这是一个非常非常非常非常长的超级无敌长长长长长长词语测试",
+  ];
+
+  #[test]
+  fn cut_matches_old_filtering() {
+    let engine = Engine {
+      jieba: Jieba::new(),
+      stop_words: ["我们", "吧"].iter().map(|s| s.to_string()).collect(),
+    };
+    let mut wc = WordCount::default();
+    let mut words = Vec::new();
+    for msg in MESSAGES {
+      words.clear();
+      engine.cut(msg, &mut words);
+      wc.add(&words);
+    }
+    let (count, result) = old_count(&engine, MESSAGES);
+    assert_eq!(wc.messages, count);
+    assert_eq!(wc.words, result);
+  }
+
+  #[test]
+  fn parallel_count_matches_sequential() {
+    let engine = Engine { jieba: Jieba::new(), stop_words: HashSet::new() };
+    let wc = engine.count(|tx| {
+      // uneven batches, sent from another thread
+      for chunk in MESSAGES.chunks(2) {
+        let batch = chunk.iter().map(|s| s.to_string()).collect();
+        if tx.send(Ok(batch)).is_err() {
+          break;
+        }
+      }
+      Ok(())
+    }).unwrap();
+    let (count, result) = old_count(&engine, MESSAGES);
+    assert_eq!(wc.messages, count);
+    assert_eq!(wc.words, result);
+  }
+
+  #[test]
+  fn reader_errors_are_returned() {
+    let engine = Engine { jieba: Jieba::new(), stop_words: HashSet::new() };
+    let r = engine.count(|tx| {
+      tx.send(Ok(vec!["你好".to_string()])).unwrap();
+      Err(eyre!("connection lost"))
+    });
+    assert!(r.is_err());
+  }
+}
@@ -0,0 +1,80 @@
+//! Which messages, lines and words are counted.
+
+/// messages not counted at all: empty ones, commands and our own replies
+pub fn skip_message(msg: &str) -> bool {
+  msg.is_empty()
+    || msg.starts_with("/luoxucloud")
+    || msg.starts_with("落絮词云为您生成消息词云")
+    || msg.starts_with("落絮词云未找到符合条件的消息")
+    || msg.starts_with("[Lisa] ")
+}
+
+/// lines that end the counting of a message (words of earlier lines count)
+pub fn stops_message(line: &str) -> bool {
+  ["[webpage]", "[poll]", "[file]", "[audio]"].iter().any(|pat| line.starts_with(pat))
+}
+
+/// whether a word tagged by jieba is worth counting, before stop words
+pub fn keep_tagged(word: &str, tag: &str) -> bool {
+  !STOP_FLAGS.contains(&tag) && word.len() <= 21
+}
+
+const STOP_FLAGS: &[&str] = &[
+  "d",  // 副词
+  "f",  // 方位名词
+  "x",  // 标点符号（文档说是 w 但是实际测试是 x
+  "p",  // 介词
+  "t",  // 时间
+  "q",  // 量词
+  "m",  // 数量词
+  "nr", // 人名，你我他
+  "r",  // 代词
+  "c",  // 连词
+  "e",  // 文档没说，看着像语气词
+  "xc", // 其他虚词
+  "zg", // 文档没说，给出的词也没找到规律，但都不是想要的
+  "y",  // 文档没说，看着像语气词
+  // u 开头的都是助词，具体细分的分类文档没说
+  "uj",
+  "ug",
+  "ul",
+  "ud",
+];
+
+#[cfg(test)]
+mod tests {
+  use super::*;
+
+  #[test]
+  fn skipped_messages() {
+    for msg in [
+      "", "/luoxucloud 7", "落絮词云为您生成消息词云\n...",
+      "落絮词云未找到符合条件的消息。", "[Lisa] hi",
+    ] {
+      assert!(skip_message(msg), "{:?}", msg);
+    }
+    for msg in ["hello", " /luoxucloud", "[Lisa]hi", "see [webpage] x"] {
+      assert!(!skip_message(msg), "{:?}", msg);
+    }
+  }
+
+  #[test]
+  fn stopping_lines() {
+    assert!(stops_message("[webpage] https://example.com"));
+    assert!(stops_message("[poll] q"));
+    assert!(stops_message("[file] a.txt"));
+    assert!(stops_message("[audio] a.ogg"));
+    assert!(!stops_message("[image]"));
+    assert!(!stops_message("a [webpage]"));
+  }
+
+  #[test]
+  fn tagged_words() {
+    assert!(keep_tagged("词云", "n"));
+    assert!(!keep_tagged("的", "uj"));
+    assert!(!keep_tagged("，", "x"));
+    // 7 CJK characters are 21 bytes
+    assert!(keep_tagged("一二三四五六七", "n"));
+    assert!(!keep_tagged("一二三四五六七八", "n"));
+  }
+}
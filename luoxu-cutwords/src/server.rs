@@ -0,0 +1,234 @@
+use std::fs;
+use std::io::{self, BufReader, BufWriter, Read, Write};
+use std::os::unix::net::{UnixListener, UnixStream};
+use std::path::Path;
+use std::sync::{Arc, Mutex};
+use std::thread;
+use std::time::{SystemTime, UNIX_EPOCH};
+
+use eyre::{Result, eyre};
+use postgres::{Client, NoTls};
+use serde::{Deserialize, Serialize};
+use tracing::{info, warn, error};
+
+use crate::aggregate;
+use crate::db::MessageQuery;
+use crate::engine::Engine;
+
+const MAX_REQUEST_SIZE: usize = 1024 * 1024;
+
+#[derive(Debug, Deserialize)]
+struct Request {
+  group_id: i64,
+  endtime: u64,
+  #[serde(default)]
+  user_id: Option<i64>,
+  /// return only this many most frequent words; 0 for all
+  #[serde(default)]
+  top: usize,
+}
+
+#[derive(Serialize)]
+#[serde(untagged)]
+enum Response {
+  Ok { messages: usize, words: Vec<(String, u64)> },
+  Err { error: String },
+}
+
+/// idle database connections kept for later requests
+struct Pool {
+  dbstring: String,
+  idle: Mutex<Vec<Client>>,
+  max_idle: usize,
+  use_aggregates: bool,
+}
+
+impl Pool {
+  fn get(&self) -> Result<Client> {
+    loop {
+      let client = self.idle.lock().unwrap().pop();
+      match client {
+        Some(c) if !c.is_closed() => return Ok(c),
+        Some(_) => continue,
+        None => break,
+      }
+    }
+    info!("connecting to database");
+    Ok(Client::connect(&self.dbstring, NoTls)?)
+  }
+
+  fn put(&self, client: Client) {
+    if client.is_closed() {
+      return;
+    }
+    let mut idle = self.idle.lock().unwrap();
+    if idle.len() < self.max_idle {
+      idle.push(client);
+    }
+  }
+}
+
+/// Serve word counting requests on a UNIX socket.
+///
+/// Requests and responses are JSON messages prefixed with their length as a
+/// 32-bit big-endian integer, and a connection may carry any number of them.
+/// A request is `{"group_id": i64, "endtime": u64, "user_id": i64?, "top":
+/// usize?}`; the response is `{"messages": n, "words": [[word, count], ...]}`
+/// sorted by count, or `{"error": "..."}`.
+pub fn serve(
+  socket: &Path, dbstring: String, pool_size: usize, use_aggregates: bool,
+) -> Result<()> {
+  let engine = Arc::new(Engine::new());
+  let pool = Arc::new(Pool {
+    dbstring,
+    idle: Mutex::new(Vec::new()),
+    max_idle: pool_size,
+    use_aggregates,
+  });
+
+  // a stale socket from a previous run
+  let _ = fs::remove_file(socket);
+  let listener = UnixListener::bind(socket)?;
+  info!("listening on {}", socket.display());
+
+  for stream in listener.incoming() {
+    let stream = match stream {
+      Ok(s) => s,
+      Err(e) => {
+        warn!("failed to accept: {}", e);
+        continue;
+      }
+    };
+    let engine = Arc::clone(&engine);
+    let pool = Arc::clone(&pool);
+    thread::spawn(move || {
+      if let Err(e) = handle_conn(stream, &engine, &pool) {
+        warn!("connection error: {:#}", e);
+      }
+    });
+  }
+
+  Ok(())
+}
+
+fn handle_conn(stream: UnixStream, engine: &Engine, pool: &Pool) -> Result<()> {
+  let mut reader = BufReader::new(stream.try_clone()?);
+  let mut writer = BufWriter::new(stream);
+  loop {
+    let mut size = [0u8; 4];
+    match reader.read_exact(&mut size) {
+      Ok(()) => {},
+      Err(e) if e.kind() == io::ErrorKind::UnexpectedEof => return Ok(()),
+      Err(e) => return Err(e.into()),
+    }
+    let size = u32::from_be_bytes(size) as usize;
+    if size > MAX_REQUEST_SIZE {
+      return Err(eyre!("request too large: {} bytes", size));
+    }
+    let mut buf = vec![0u8; size];
+    reader.read_exact(&mut buf)?;
+
+    let resp = match serde_json::from_slice::<Request>(&buf) {
+      Ok(req) => {
+        info!("request: {:?}", req);
+        process(req, engine, pool).unwrap_or_else(|e| {
+          error!("failed to process request: {:#}", e);
+          Response::Err { error: format!("{:#}", e) }
+        })
+      },
+      Err(e) => Response::Err { error: format!("bad request: {}", e) },
+    };
+
+    let data = serde_json::to_vec(&resp)?;
+    writer.write_all(&(data.len() as u32).to_be_bytes())?;
+    writer.write_all(&data)?;
+    writer.flush()?;
+  }
+}
+
+fn process(req: Request, engine: &Engine, pool: &Pool) -> Result<Response> {
+  let mut client = pool.get()?;
+  let until = far_future();
+  let result = if pool.use_aggregates {
+    aggregate::count(&mut client, engine, req.group_id, req.endtime, until, req.user_id)
+  } else {
+    let q = MessageQuery {
+      group_id: req.group_id,
+      since: req.endtime,
+      until,
+      user_id: req.user_id,
+    };
+    engine.count(|tx| q.stream(&mut client, tx))
+  };
+  pool.put(client);
+  let wc = result?;
+  Ok(Response::Ok {
+    messages: wc.messages,
+    words: wc.top(req.top),
+  })
+}
+
+/// an upper bound for messages' time that includes everything
+pub fn far_future() -> u64 {
+  SystemTime::now()
+    .duration_since(UNIX_EPOCH)
+    .map(|d| d.as_secs())
+    .unwrap_or(0) + 86400
+}
+
+#[cfg(test)]
+mod tests {
+  use super::*;
+
+  fn send(mut stream: &UnixStream, data: &[u8]) {
+    stream.write_all(&(data.len() as u32).to_be_bytes()).unwrap();
+    stream.write_all(data).unwrap();
+  }
+
+  fn recv(mut stream: &UnixStream) -> serde_json::Value {
+    let mut size = [0u8; 4];
+    stream.read_exact(&mut size).unwrap();
+    let mut buf = vec![0u8; u32::from_be_bytes(size) as usize];
+    stream.read_exact(&mut buf).unwrap();
+    serde_json::from_slice(&buf).unwrap()
+  }
+
+  fn pool() -> Pool {
+    // never connected to: these requests fail before reaching the database
+    Pool {
+      dbstring: String::new(),
+      idle: Mutex::new(Vec::new()),
+      max_idle: 0,
+      use_aggregates: false,
+    }
+  }
+
+  #[test]
+  fn bad_requests_keep_the_connection() {
+    let engine = Engine::new();
+    let pool = pool();
+    let (client, server) = UnixStream::pair().unwrap();
+    thread::scope(|s| {
+      let h = s.spawn(|| handle_conn(server, &engine, &pool));
+      for req in [&b"not json"[..], br#"{"endtime": 1}"#] {
+        send(&client, req);
+        let resp = recv(&client);
+        let error = resp["error"].as_str().unwrap();
+        assert!(error.starts_with("bad request: "), "{}", error);
+      }
+      drop(client);
+      h.join().unwrap().unwrap();
+    });
+  }
+
+  #[test]
+  fn too_large_requests_close_the_connection() {
+    let engine = Engine::new();
+    let pool = pool();
+    let (mut client, server) = UnixStream::pair().unwrap();
+    client.write_all(&(MAX_REQUEST_SIZE as u32 + 1).to_be_bytes()).unwrap();
+    assert!(handle_conn(server, &engine, &pool).is_err());
+    let mut buf = Vec::new();
+    assert_eq!(client.read_to_end(&mut buf).unwrap(), 0);
+  }
+}
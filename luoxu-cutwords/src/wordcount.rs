@@ -0,0 +1,84 @@
+use std::collections::HashMap;
+
+#[derive(Debug, Default, PartialEq)]
+pub struct WordCount {
+  pub messages: usize,
+  pub words: HashMap<String, u64>,
+}
+
+impl WordCount {
+  /// count a message with its words
+  pub fn add(&mut self, words: &[String]) {
+    self.messages += 1;
+    for word in words {
+      match self.words.get_mut(word) {
+        Some(c) => *c += 1,
+        None => { self.words.insert(word.clone(), 1); },
+      }
+    }
+  }
+
+  pub fn merge(&mut self, other: WordCount) {
+    self.messages += other.messages;
+    for (word, n) in other.words {
+      *self.words.entry(word).or_insert(0) += n;
+    }
+  }
+
+  /// words sorted by count, descending (then by word); all of them if n is 0
+  pub fn top(self, n: usize) -> Vec<(String, u64)> {
+    let mut words: Vec<_> = self.words.into_iter().collect();
+    let cmp = |a: &(String, u64), b: &(String, u64)| b.1.cmp(&a.1).then_with(|| a.0.cmp(&b.0));
+    if n > 0 && n < words.len() {
+      words.select_nth_unstable_by(n - 1, cmp);
+      words.truncate(n);
+    }
+    words.sort_unstable_by(cmp);
+    words
+  }
+}
+
+#[cfg(test)]
+mod tests {
+  use super::*;
+
+  fn count(msgs: &[&[&str]]) -> WordCount {
+    let mut wc = WordCount::default();
+    for words in msgs {
+      let words: Vec<String> = words.iter().map(|w| w.to_string()).collect();
+      wc.add(&words);
+    }
+    wc
+  }
+
+  #[test]
+  fn add_counts_messages_without_words() {
+    let wc = count(&[&["a", "b", "a"], &[], &["b"]]);
+    assert_eq!(wc.messages, 3);
+    assert_eq!(wc.words["a"], 2);
+    assert_eq!(wc.words["b"], 2);
+  }
+
+  #[test]
+  fn merge_equals_counting_together() {
+    let msgs: &[&[&str]] = &[&["a", "b"], &["c"], &["a"], &["b", "b"]];
+    let mut merged = count(&msgs[..2]);
+    merged.merge(count(&msgs[2..]));
+    assert_eq!(merged, count(msgs));
+  }
+
+  #[test]
+  fn top_is_sorted_prefix_of_all() {
+    let msgs: &[&[&str]] = &[
+      &["x", "y", "z", "w"], &["y", "z", "w"], &["z", "w"], &["w"], &["v"],
+    ];
+    let all = count(msgs).top(0);
+    assert_eq!(all, vec![
+      ("w".to_string(), 4), ("z".to_string(), 3), ("y".to_string(), 2),
+      ("v".to_string(), 1), ("x".to_string(), 1),
+    ]);
+    for n in 1..=all.len() + 1 {
+      assert_eq!(count(msgs).top(n), all[..n.min(all.len())]);
+    }
+  }
+}
@@ -1,5 +1,4 @@
 import os
-import re
 import asyncio
 import logging
 import operator
@@ -7,13 +6,18 @@ from functools import partial
 import importlib
 import inspect
 
-from telethon import events
+from telethon import events, types
 from aiohttp import web
 
 from .db import PostgreStore
 from .group import GroupHistoryIndexer
+from .scheduler import HistoryScheduler
+from .gaps import GapRepairer
+from .sweeper import EditSweeper
+from .dispatch import MsgDispatcher, PluginPool
 from .util import load_config, UpdateLoaded, create_client
 from . import web as myweb
+from . import tracing
 from .ctxvars import msg_source
 
 logger = logging.getLogger(__name__)
@@ -23,7 +27,7 @@ class Indexer:
     self.config = config
     self.mark_as_read = config['telegram'].get('mark_as_read', True)
     self.dbstore = None
-    self.msg_handlers = []
+    self.dispatcher = MsgDispatcher()
 
   async def load_plugins(self, client):
     for plugin, conf in self.config.get('plugin', {}).items():
@@ -31,13 +35,23 @@ class Indexer:
         continue
 
       logger.info('loading plugin %s', plugin)
+      self.dispatcher.add_pool(PluginPool(
+        plugin,
+        workers = conf.get('workers', PluginPool.DEFAULT_WORKERS),
+        queue_size = conf.get('queue_size', 100),
+        policy = conf.get('queue_policy', 'drop_new'),
+      ))
       mod = importlib.import_module(f'luoxu_plugins.{plugin}')
       ret = mod.register(self, client)
       if inspect.isawaitable(ret):
         await ret
 
-  def add_msg_handler(self, handler, pattern='.*'):
-    self.msg_handlers.append((handler, re.compile(pattern)))
+  def add_msg_handler(self, handler, pattern='.*', plugin=None):
+    '''plugin: whose workers run the handler; defaults to the plugin
+    module the handler is defined in'''
+    if plugin is None:
+      plugin = handler.__module__.removeprefix('luoxu_plugins.').split('.')[0]
+    self.dispatcher.add_handler(handler, pattern, plugin)
 
   async def on_message(self, event):
     if isinstance(event, events.MessageEdited.Event):
@@ -60,16 +74,16 @@ class Indexer:
       except ConnectionError as e:
         logger.warning('cannot mark as read: %r', e)
 
-    for handler, pattern in self.msg_handlers:
-      logger.debug('message: %s, pattern: %s', msg.text, pattern)
-      if pattern.fullmatch(msg.text):
-        asyncio.create_task(handler(event))
+    self.dispatcher.dispatch(event, msg.text)
 
   async def run(self):
     config = self.config
     tg_config = config['telegram']
     client = create_client(tg_config)
 
+    if tracing_config := config.get('tracing'):
+      tracing.setup(tracing_config)
+
     db = PostgreStore(config['database'], client)
     await db.setup()
     self.dbstore = db
@@ -84,6 +98,7 @@ class Indexer:
       os.path.abspath(web_config['ghost_avatar']),
       prefix = web_config['prefix'],
       origins = web_config['origins'],
+      enable_metrics = web_config.get('metrics', False),
     )
     runner = web.AppRunner(app)
     await runner.setup()
@@ -96,27 +111,27 @@ class Indexer:
     await client.start(tg_config['account'])
     index_group_ids = []
     ocr_ignore_group_ids = []
-    group_entities = []
-    dialogs = None
-    for g in tg_config['index_groups']:
-      if g.startswith('@'):
-        group = await client.get_entity(g)
-      else:
-        g2 = int(g)
-        try:
-          group = await client.get_entity(g2)
-        except ValueError:
-          if dialogs is None:
-            dialogs = await client.get_dialogs()
-          group = [d.entity for d in dialogs if d.entity.id == g2][0]
-
+    backfill_workers = {}
+    group_entities = await self.resolve_groups(client, db, tg_config['index_groups'])
+    for g, group in zip(tg_config['index_groups'], group_entities):
       if g in tg_config.get('ocr_ignore_groups', ()):
         ocr_ignore_group_ids.append(group.id)
+      if n := tg_config.get('backfill_workers', {}).get(g):
+        backfill_workers[group.id] = n
 
       index_group_ids.append(group.id)
-      group_entities.append(group)
 
     self.ocr_ignore_group_ids = ocr_ignore_group_ids
+    self.scheduler = HistoryScheduler(
+      client,
+      rate = tg_config.get('history_rate', 1.0),
+      burst = tg_config.get('history_burst', 5),
+      per_group = tg_config.get('history_group_concurrency', 1),
+    )
+    self.backfill_workers = backfill_workers
+    for group_id, n in backfill_workers.items():
+      # one more for going forward
+      self.scheduler.set_group_concurrency(group_id, n + 1)
     client.add_event_handler(self.on_message, events.NewMessage(chats=index_group_ids))
     client.add_event_handler(self.on_message, events.MessageEdited(chats=index_group_ids))
 
@@ -141,17 +156,118 @@ class Indexer:
     finally:
       await runner.cleanup()
 
+  async def resolve_groups(self, client, db, groups):
+    '''resolve groups in index_groups to entities
+
+    Entities saved in tg_groups by this account are reused, and refreshed
+    by refresh_groups after connecting; the rest are resolved concurrently
+    and saved for the next start.'''
+    me = await client.get_me(input_peer=True)
+    by_id = {}
+    by_name = {}
+    for row in await db.get_groups():
+      # the columns are missing on databases not yet altered
+      if row.get('access_hash') is None or row.get('access_user_id') != me.user_id:
+        continue
+      entity = types.Channel(
+        id = row['group_id'],
+        title = row['name'],
+        photo = types.ChatPhotoEmpty(),
+        date = None,
+        access_hash = row['access_hash'],
+        username = row['pub_id'],
+      )
+      by_id[entity.id] = entity
+      if entity.username:
+        by_name[entity.username.lower()] = entity
+
+    def cached(g):
+      if g.startswith('@'):
+        return by_name.get(g[1:].lower())
+      else:
+        return by_id.get(int(g))
+
+    dialogs = None
+    dialogs_lock = asyncio.Lock()
+
+    async def resolve(g):
+      nonlocal dialogs
+      if g.startswith('@'):
+        return await client.get_entity(g)
+      g2 = int(g)
+      try:
+        return await client.get_entity(g2)
+      except ValueError:
+        # fetching dialogs is slow; do it once for all groups that need it
+        async with dialogs_lock:
+          if dialogs is None:
+            dialogs = await client.get_dialogs()
+        return [d.entity for d in dialogs if d.entity.id == g2][0]
+
+    missing = [g for g in groups if cached(g) is None]
+    if missing:
+      logger.info('resolving groups: %s', ', '.join(missing))
+      resolved = dict(zip(missing, await asyncio.gather(*(resolve(g) for g in missing))))
+      entities = {e.id: e for e in resolved.values()}
+      await db.upsert_groups(list(entities.values()), me.user_id)
+    else:
+      resolved = {}
+    return [cached(g) or resolved[g] for g in groups]
+
+  async def refresh_groups(self, client, db, group_entities):
+    '''fetch groups again in one request to save title and username changes
+
+    Entities from tg_groups carry the names saved last time.'''
+    try:
+      fresh = await client.get_entity(group_entities)
+      me = await client.get_me(input_peer=True)
+      await db.upsert_groups(fresh, me.user_id)
+    except Exception:
+      logger.exception('failed to refresh group names')
+      return
+    for entity, f in zip(group_entities, fresh):
+      entity.title = f.title
+      entity.username = getattr(f, 'username', None)
+
   async def run_on_connected(self, client, db, group_entities):
     self.group_forward_history_done = {}
     runnables = []
+    groups_ocr = []
+    ginfos = await db.get_groups_by_ids([g.id for g in group_entities])
     for group in group_entities:
-      ginfo = await self.init_group(group)
+      ginfo = ginfos[group.id]
       use_ocr = group.id not in self.ocr_ignore_group_ids
-      gi = GroupHistoryIndexer(group, ginfo, use_ocr)
+      groups_ocr.append((group, use_ocr))
+      gi = GroupHistoryIndexer(
+        group, ginfo, use_ocr, self.scheduler,
+        prefetch = self.config['telegram'].get('history_prefetch', 2),
+        backfill_workers = self.backfill_workers.get(group.id, 1),
+      )
       runnables.append(gi.run(
-        client, db,
+        db,
         partial(operator.setitem, self.group_forward_history_done, group.id, True)
       ))
+    if db.ocrqueue:
+      runnables.append(db.ocrqueue.run(self.scheduler))
+    if db.spool:
+      runnables.append(db.replay_spool())
+    runnables.append(db.partitions.run())
+    runnables.append(self.refresh_groups(client, db, group_entities))
+    if db.track_gaps:
+      repairer = GapRepairer(
+        db, self.scheduler, groups_ocr,
+        interval = self.config['database'].get('gap_repair_interval', 3600),
+      )
+      runnables.append(repairer.run())
+    tg_config = self.config['telegram']
+    if sweep_days := tg_config.get('edit_sweep_days', 0):
+      sweeper = EditSweeper(
+        db, self.scheduler, groups_ocr,
+        days = sweep_days,
+        interval = tg_config.get('edit_sweep_interval', 3600),
+        budget = tg_config.get('edit_sweep_budget', 100),
+      )
+      runnables.append(sweeper.run())
 
     if not client.is_connected():
       await client.start(self.config['telegram']['account'])
@@ -166,7 +282,7 @@ class Indexer:
     # don't see some missed updates (I don't know why).
     #
     # we may still miss edits that happen while we're offline and missed
-    # the updates.
+    # the updates, unless the edit sweeper is enabled.
     gis = asyncio.gather(*runnables)
     # await client.catch_up()
     try:
@@ -178,11 +294,6 @@ class Indexer:
       except asyncio.CancelledError:
         pass
 
-  async def init_group(self, group):
-    logger.info('init_group: %r', group.title)
-    async with self.dbstore.get_conn() as conn:
-      return await self.dbstore.insert_group(conn, group)
-
 if __name__ == '__main__':
   from .lib.nicelogger import enable_pretty_logging
   # enable_pretty_logging('DEBUG')
@@ -0,0 +1,84 @@
+'''
+Build the group-aware full-text index message_group_idx on an existing
+database, one partition at a time without blocking writes.
+
+The index is created on the partitioned table only (invalid until complete),
+then concurrently on each partition and attached. It is safe to run again
+after an interruption: invalid leftovers are rebuilt and finished partitions
+are skipped. Partitions created later get the index automatically.
+'''
+
+import asyncio
+import argparse
+import logging
+
+import asyncpg
+
+from .util import load_config
+from .partitions import list_partitions
+
+logger = logging.getLogger(__name__)
+
+INDEX = 'message_group_idx'
+INDEX_DEF = '''USING pgroonga (text, group_id, created_at) WITH (tokenizer='TokenNgram("report_source_location", true, "loose_blank", true)')'''
+
+async def index_state(conn, name: str):
+  '''None if the index doesn't exist, else whether it's valid'''
+  sql = '''\
+      select i.indisvalid from pg_index i
+      join pg_class c on c.oid = i.indexrelid
+      where c.relname = $1'''
+  return await conn.fetchval(sql, name)
+
+async def is_attached(conn, name: str) -> bool:
+  sql = '''\
+      select exists (
+        select 1 from pg_inherits
+        where inhrelid = $1::regclass and inhparent = $2::regclass
+      )'''
+  return await conn.fetchval(sql, name, INDEX)
+
+async def build(conn, drop_old: bool) -> None:
+  await conn.execute(f'CREATE INDEX IF NOT EXISTS {INDEX} ON ONLY messages {INDEX_DEF}')
+
+  for p in await list_partitions(conn):
+    name = f'{p.name}_group_idx'
+    state = await index_state(conn, name)
+    if state is False:
+      logger.warning('dropping invalid index %s left by an interrupted build', name)
+      await conn.execute(f'DROP INDEX CONCURRENTLY {name}')
+      state = None
+    if state is None:
+      logger.info('building %s', name)
+      await conn.execute(f'CREATE INDEX CONCURRENTLY {name} ON {p.name} {INDEX_DEF}')
+    if not await is_attached(conn, name):
+      await conn.execute(f'ALTER INDEX {INDEX} ATTACH PARTITION {name}')
+
+  if not await index_state(conn, INDEX):
+    # e.g. a partition without range bounds we don't know about
+    logger.error('%s is still invalid; indexes of some partitions are missing', INDEX)
+    return
+  logger.info('%s is ready', INDEX)
+
+  if drop_old:
+    logger.info('dropping message_idx')
+    await conn.execute('DROP INDEX IF EXISTS message_idx')
+
+async def main():
+  parser = argparse.ArgumentParser(description='build the group-aware full-text index')
+  parser.add_argument('--config', default='config.toml',
+                      help='config file path')
+  parser.add_argument('--drop-old', action='store_true',
+                      help='drop the text-only index message_idx afterwards')
+  args = parser.parse_args()
+  config = load_config(args.config)
+  conn = await asyncpg.connect(config['database']['url'])
+  try:
+    await build(conn, args.drop_old)
+  finally:
+    await conn.close()
+
+if __name__ == '__main__':
+  from .lib.nicelogger import enable_pretty_logging
+  enable_pretty_logging('INFO')
+  asyncio.run(main())
@@ -2,3 +2,4 @@ from contextvars import ContextVar
 
 msg_source = ContextVar('msg_source', default=None)
 group_title = ContextVar('group_title', default=None)
+current_span = ContextVar('current_span', default=None)
@@ -4,80 +4,265 @@ from typing import Literal, Any
 import asyncio
 from random import randint
 import datetime
+import time
 
 import asyncpg
+from telethon.tl.patched import MessageService
 
 from .util import format_name, UpdateLoaded
-from .indexing import text_to_query, format_msg
+from .indexing import text_to_query, format_msgs, has_image
 from .types import SearchQuery, GroupNotFound
 from .ctxvars import msg_source, group_title
 from .ocr import OCRService
 from .mediamgr import MediaMgr
+from .ocrqueue import OCRQueue
+from .gaps import merge_ranges, find_holes, subtract_ids
+from .spool import Spool
+from .partitions import PartitionManager
+from . import metrics
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
+# the database is down or too slow; spool the batch instead
+SPOOL_ERRORS = (
+  OSError,
+  asyncio.TimeoutError,
+  asyncpg.InterfaceError,
+  asyncpg.PostgresConnectionError,
+  asyncpg.exceptions.CannotConnectNowError,
+  asyncpg.exceptions.TooManyConnectionsError,
+)
+
+def _encode_batch(batch: dict) -> dict:
+  return {
+    **batch,
+    'rows': [
+      (*row[:4], row[4].isoformat(), row[5] and row[5].isoformat())
+      for row in batch['rows']
+    ],
+    'ocr': [(msgid, created_at.isoformat()) for msgid, created_at in batch['ocr']],
+  }
+
+def _decode_batch(record: dict) -> dict:
+  fromiso = datetime.datetime.fromisoformat
+  return {
+    **record,
+    'rows': [
+      (*row[:4], fromiso(row[4]), row[5] and fromiso(row[5]))
+      for row in record['rows']
+    ],
+    'ocr': [(msgid, fromiso(created_at)) for msgid, created_at in record['ocr']],
+  }
+
 class PostgreStore:
   SEARCH_LIMIT = 50
 
   def __init__(self, config: dict[str, Any], client) -> None:
     self.address = config['url']
-    first_year = config.get('first_year', 2016)
-    self.mediamgr = MediaMgr(client)
+    self.mediamgr = MediaMgr(
+      client,
+      memory_budget = config.get('media_memory_budget', 64 * 1024 * 1024),
+      spill_size = config.get('media_spill_size', 4 * 1024 * 1024),
+      tmpdir = config.get('media_tmpdir'),
+      concurrency = config.get('download_concurrency', 0),
+    )
     if ocr_url := config.get('ocr_url'):
-      self.ocrsvc = OCRService(self.mediamgr, ocr_url, config.get('ocr_socket'))
+      self.ocrsvc = OCRService(
+        self.mediamgr, ocr_url, config.get('ocr_socket'),
+        dbstore = self if config.get('ocr_persist', False) else None,
+        engine = config.get('ocr_engine', 'paddleocr'),
+        min_photo_size = config.get('ocr_min_photo_size', 0),
+        max_document_size = config.get('ocr_max_document_size', 0),
+        dedup_distance = config.get('ocr_dedup_distance'),
+        concurrency = config.get('ocr_concurrency', 0),
+      )
     else:
       self.ocrsvc = None
-    self.earliest_time = datetime.datetime(first_year, 1, 1).astimezone()
+    if self.ocrsvc and (ocr_workers := config.get('ocr_workers', 0)):
+      self.ocrqueue = OCRQueue(self, client, self.ocrsvc, ocr_workers)
+    else:
+      self.ocrqueue = None
+    self.format_concurrency = config.get('format_concurrency', 4)
+    self.track_gaps = config.get('track_gaps', False)
+    if spool_dir := config.get('spool_dir'):
+      self.spool = Spool(spool_dir)
+    else:
+      self.spool = None
+    self.spool_timeout = config.get('spool_timeout', 5)
+    self.partitions = PartitionManager(
+      self,
+      granularity = config.get('partition_granularity', 'year'),
+      ahead = config.get('partitions_ahead', 1),
+    )
     self.pool = None
+    # whether tg_groups has the access_hash and access_user_id columns
+    self.group_access = False
 
   async def setup(self) -> None:
     self.pool = await asyncpg.create_pool(self.address)
+    metrics.register_db_pool(self.pool)
+    self.group_access = await self._has_group_access()
+    if not self.group_access:
+      logger.warning(
+        'tg_groups has no access_hash column, so groups are resolved on every '
+        'start. Add it with: alter table tg_groups add column access_hash '
+        'bigint, add column access_user_id bigint;')
+    await self.partitions.ensure()
+    if self.track_gaps:
+      # before any batch records ranges, or a group's whole window would
+      # look like a hole
+      await self.seed_loaded_ranges()
 
-  async def _insert_one_message(self, conn, msg, text):
-    u = await msg.get_sender()
-    sql = '''
-      INSERT INTO messages (group_id, msgid, from_user, from_user_name, text, created_at, updated_at)
-      VALUES ($1, $2, $3, $4, $5, $6, $7)
-      ON CONFLICT (group_id, msgid, created_at) DO UPDATE
-        SET text = EXCLUDED.text, updated_at = EXCLUDED.updated_at
-    '''
-    logger.info('%7s <%s> [%s] %s: %s', msg_source.get(), getattr(msg.chat, 'title', None), msg.id, format_name(u), text)
-    await conn.execute(sql,
-      msg.peer_id.channel_id,
-      msg.id,
-      u.id if u else None,
-      format_name(u),
-      text,
-      msg.date,
-      msg.edit_date,
-    )
+  async def insert_messages(
+    self, msgs, update_loaded, use_ocr = True, covered = None,
+    skipped = (), formatted = None,
+  ):
+    '''covered: the (first, last) message id range known to be complete with
+    msgs, defaulting to that of msgs; recorded if track_gaps is set, except
+    for ids in skipped (not checked, so still gaps).
 
-  async def insert_messages(self, msgs, update_loaded, use_ocr = True):
+    formatted: {msgid: text} of msgs already formatted without OCR, used
+    unless OCR is to be done before indexing them'''
+    with span('batch', count=len(msgs)):
+      await self._insert_messages(msgs, update_loaded, use_ocr, covered, skipped, formatted)
+
+  async def _insert_messages(self, msgs, update_loaded, use_ocr, covered, skipped, formatted):
     use_ocr = self.ocrsvc and use_ocr
-    data = []
-    for msg in msgs:
-      group_title.set(getattr(msg.chat, 'title', None))
-      text = await format_msg(msg, self.ocrsvc if use_ocr else None)
-      if text is not None:
-        data.append((msg, text))
-
-    if not data:
+    # OCR is done later by the queue if enabled
+    defer_ocr = use_ocr and self.ocrqueue
+    # messages in a batch are from the same group
+    group_title.set(getattr(msgs[0].chat, 'title', None))
+    formatted = dict(formatted or {})
+    if use_ocr and not defer_ocr:
+      for msg in msgs:
+        if has_image(msg):
+          formatted.pop(msg.id, None)
+    todo = [msg for msg in msgs if msg.id not in formatted]
+    formatted.update(zip((msg.id for msg in todo), await format_msgs(
+      todo, self.ocrsvc if use_ocr and not defer_ocr else None,
+      concurrency = self.format_concurrency,
+    )))
+    texts = [formatted[msg.id] for msg in msgs]
+    data = [(msg, text) for msg, text in zip(msgs, texts) if text is not None]
+
+    if self.track_gaps:
+      if covered is None:
+        covered = min(m.id for m in msgs), max(m.id for m in msgs)
+      # messages that failed to format are left as gaps to repair later
+      failed = [msg.id for msg, text in zip(msgs, texts)
+                if text is None and not isinstance(msg, MessageService)]
+      covered_ranges = subtract_ids(*covered, [*failed, *skipped])
+    else:
+      covered_ranges = []
+
+    if not data and not covered_ranges:
       return
 
+    rows = []
+    for msg, text in data:
+      with span('get_sender', msgid=msg.id):
+        u = await msg.get_sender()
+      logger.info('%7s <%s> [%s] %s: %s', msg_source.get(), getattr(msg.chat, 'title', None), msg.id, format_name(u), text)
+      rows.append((
+        msg.id, u.id if u else None, format_name(u), text, msg.date, msg.edit_date,
+      ))
+
+    loaded_last = loaded_first = None
+    if data:
+      if update_loaded in [UpdateLoaded.update_last, UpdateLoaded.update_both]:
+        loaded_last = msgs[-1].id
+      if update_loaded in [UpdateLoaded.update_first, UpdateLoaded.update_both]:
+        loaded_first = msgs[0].id
+
+    batch = {
+      'group_id': msgs[0].peer_id.channel_id,
+      'source': msg_source.get(),
+      'rows': rows,
+      'ocr': [(msg.id, msg.date) for msg, _ in data if defer_ocr and has_image(msg)],
+      'covered': covered_ranges,
+      'loaded_last': loaded_last,
+      'loaded_first': loaded_first,
+    }
+
+    if self.spool is None:
+      await self._write_batch(batch)
+      return
+
+    # keep the order of writes: while there are spooled batches, new ones
+    # go after them
+    if not self.spool.active:
+      try:
+        await asyncio.wait_for(self._write_batch(batch), self.spool_timeout)
+        return
+      except SPOOL_ERRORS as e:
+        logger.warning('cannot write to database, spooling %d messages: %r', len(rows), e)
+    with span('spool', count=len(rows)):
+      await self.spool.append(_encode_batch(batch))
+
+  async def _write_batch(self, batch) -> None:
     while True:
       try:
         async with self.get_conn() as conn:
-          for msg, text in data:
-            await self._insert_one_message(conn, msg, text)
-          if update_loaded in [UpdateLoaded.update_last, UpdateLoaded.update_both]:
-            await self.loaded_upto(conn, msg.peer_id.channel_id, 1, msgs[-1].id)
-          if update_loaded in [UpdateLoaded.update_first, UpdateLoaded.update_both]:
-            await self.loaded_upto(conn, msg.peer_id.channel_id, -1, msgs[0].id)
-          break
+          await self._apply_batch(conn, batch)
+        break
       except asyncpg.exceptions.DeadlockDetectedError:
         t = randint(1, 50) / 10
         logger.warning('deadlock detected, retry in %.1fs', t)
         await asyncio.sleep(t)
+    self._batch_written(batch)
+
+  async def _apply_batch(self, conn, batch) -> None:
+    group_id = batch['group_id']
+    sql = '''
+      INSERT INTO messages (group_id, msgid, from_user, from_user_name, text, created_at, updated_at)
+      VALUES ($1, $2, $3, $4, $5, $6, $7)
+      ON CONFLICT (group_id, msgid, created_at) DO UPDATE
+        SET text = EXCLUDED.text, updated_at = EXCLUDED.updated_at
+    '''
+    with span('db_upsert', count=len(batch['rows'])):
+      await conn.executemany(sql, [(group_id, *row) for row in batch['rows']])
+    if self.ocrqueue:
+      for msgid, created_at in batch['ocr']:
+        await self.ocrqueue.add_job(conn, group_id, msgid, created_at)
+    for first, last in batch['covered']:
+      await self._record_loaded(conn, group_id, first, last)
+    if batch['loaded_last'] is not None:
+      await self.loaded_upto(conn, group_id, 1, batch['loaded_last'])
+    if batch['loaded_first'] is not None:
+      await self.loaded_upto(conn, group_id, -1, batch['loaded_first'])
+
+  def _batch_written(self, batch) -> None:
+    if batch['ocr'] and self.ocrqueue:
+      self.ocrqueue.wakeup()
+
+    group_id = batch['group_id']
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for row in batch['rows']:
+      metrics.ingested_messages.labels(group_id, batch['source']).inc()
+      metrics.ingest_lag_seconds.labels(batch['source']).observe(
+        (now - row[4]).total_seconds())
+
+  async def replay_spool(self) -> None:
+    '''write spooled batches to the database whenever there are some'''
+    while True:
+      await self.spool.wait()
+      try:
+        await self.spool.replay(self._replay_batches)
+      except SPOOL_ERRORS as e:
+        logger.warning('database unavailable, retry replaying spool in 5s: %r', e)
+        await asyncio.sleep(5)
+      except Exception:
+        logger.exception('failed to replay spool, retry in 60s')
+        await asyncio.sleep(60)
+
+  async def _replay_batches(self, records: list[dict]) -> None:
+    batches = [_decode_batch(r) for r in records]
+    async with self.get_conn() as conn:
+      for batch in batches:
+        await self._apply_batch(conn, batch)
+    for batch in batches:
+      self._batch_written(batch)
 
   async def get_group(self, conn, group_id: int):
     sql = '''\
@@ -85,22 +270,92 @@ class PostgreStore:
         where group_id = $1'''
     return await conn.fetchrow(sql, group_id)
 
-  async def insert_group(self, conn, group):
-    g = await self.get_group(conn, group.id)
-    if g:
-      return g
+  async def _has_group_access(self) -> bool:
+    sql = '''\
+        select exists (
+          select 1 from information_schema.columns
+          where table_name = 'tg_groups' and column_name = 'access_hash'
+        )'''
+    async with self.get_conn() as conn:
+      return await conn.fetchval(sql)
+
+  async def upsert_groups(self, groups, access_user_id: int) -> None:
+    '''save resolved group entities in one statement
+
+    Access hashes are only valid for the account that got them, which is
+    recorded as access_user_id. They are not saved on databases created
+    before these columns.'''
+    if not self.group_access:
+      sql = '''\
+          insert into tg_groups (group_id, name, pub_id)
+          select g, n, p
+          from unnest($1::bigint[], $2::text[], $3::text[]) as t(g, n, p)
+          on conflict (group_id) do update
+            set name = excluded.name, pub_id = excluded.pub_id'''
+      async with self.get_conn() as conn:
+        await conn.execute(
+          sql,
+          [g.id for g in groups],
+          [g.title for g in groups],
+          [getattr(g, 'username', None) for g in groups],
+        )
+      return
 
     sql = '''\
         insert into tg_groups
-        (group_id, name, pub_id) values
-        ($1,       $2,  $3)
-        returning *'''
-    return await conn.fetchrow(
-      sql,
-      group.id,
-      group.title,
-      group.username,
-    )
+        (group_id, name, pub_id, access_hash, access_user_id)
+        select g, n, p, h, $5
+        from unnest($1::bigint[], $2::text[], $3::text[], $4::bigint[]) as t(g, n, p, h)
+        on conflict (group_id) do update
+          set name = excluded.name, pub_id = excluded.pub_id,
+              access_hash = excluded.access_hash,
+              access_user_id = excluded.access_user_id'''
+    async with self.get_conn() as conn:
+      await conn.execute(
+        sql,
+        [g.id for g in groups],
+        [g.title for g in groups],
+        [getattr(g, 'username', None) for g in groups],
+        [getattr(g, 'access_hash', None) for g in groups],
+        access_user_id,
+      )
+
+  async def get_groups_by_ids(self, group_ids: list[int]) -> dict[int, asyncpg.Record]:
+    async with self.get_conn() as conn:
+      sql = '''select * from tg_groups where group_id = any($1::bigint[])'''
+      rows = await conn.fetch(sql, group_ids)
+    return {r['group_id']: r for r in rows}
+
+  async def get_backfill_ranges(self, group_id: int) -> list[dict[str, int]]:
+    async with self.get_conn() as conn:
+      sql = '''\
+          select range_start, range_end, cursor from backfill_ranges
+          where group_id = $1
+          order by range_start'''
+      return [dict(r) for r in await conn.fetch(sql, group_id)]
+
+  async def create_backfill_ranges(self, group_id: int, ranges: list[dict[str, int]]) -> None:
+    async with self.get_conn() as conn:
+      await conn.executemany('''\
+          insert into backfill_ranges
+          (group_id, range_start, range_end, cursor) values
+          ($1,       $2,          $3,        $4)''',
+        [(group_id, r['range_start'], r['range_end'], r['cursor']) for r in ranges],
+      )
+
+  async def backfill_progress(
+    self, group_id: int, range_start: int, cursor: int, first_id: int,
+  ) -> None:
+    async with self.get_conn() as conn:
+      sql = '''\
+          update backfill_ranges set cursor = $3
+          where group_id = $1 and range_start = $2'''
+      await conn.execute(sql, group_id, range_start, cursor)
+      await self.loaded_upto(conn, group_id, -1, first_id)
+
+  async def delete_backfill_ranges(self, group_id: int) -> None:
+    async with self.get_conn() as conn:
+      await conn.execute('delete from backfill_ranges where group_id = $1', group_id)
 
   async def loaded_upto(
     self, conn, group_id: int,
@@ -116,14 +371,103 @@ class PostgreStore:
       sql = '''update tg_groups set loaded_first_id = $1 where group_id = $2'''
     else:
       raise ValueError(direction)
-    await conn.execute(sql, msgid, group_id)
+    with span('loaded_upto', direction=direction, msgid=msgid):
+      await conn.execute(sql, msgid, group_id)
+
+  async def record_loaded(self, group_id: int, first: int, last: int) -> None:
+    if not self.track_gaps or first > last:
+      return
+    async with self.get_conn() as conn:
+      await self._record_loaded(conn, group_id, first, last)
+
+  async def _record_loaded(self, conn, group_id: int, first: int, last: int) -> None:
+    '''merge [first, last] into the loaded ranges of a group'''
+    sql = '''\
+        delete from loaded_ranges
+        where group_id = $1 and first_id <= $3 + 1 and last_id >= $2 - 1
+        returning first_id, last_id'''
+    rows = await conn.fetch(sql, group_id, first, last)
+    [(first, last)] = merge_ranges([(first, last)] + [tuple(r) for r in rows])
+    sql = '''\
+        insert into loaded_ranges
+        (group_id, first_id, last_id) values
+        ($1,       $2,       $3)
+        on conflict (group_id, first_id) do update
+          set last_id = greatest(loaded_ranges.last_id, EXCLUDED.last_id)'''
+    await conn.execute(sql, group_id, first, last)
+
+  async def seed_loaded_ranges(self) -> None:
+    '''treat the loaded window of groups without loaded ranges as covered'''
+    async with self.get_conn() as conn:
+      sql = '''\
+          insert into loaded_ranges (group_id, first_id, last_id)
+          select group_id, loaded_first_id, loaded_last_id from tg_groups g
+          where loaded_first_id is not null and loaded_last_id is not null
+            and not exists (select 1 from loaded_ranges r where r.group_id = g.group_id)'''
+      await conn.execute(sql)
+
+  async def find_holes(self, group_id: int) -> list[tuple[int, int]]:
+    '''id ranges inside the loaded window of a group that aren't covered'''
+    async with self.get_conn() as conn:
+      group = await self.get_group(conn, group_id)
+      if not group or group['loaded_first_id'] is None or group['loaded_last_id'] is None:
+        return []
+      sql = '''\
+          select first_id, last_id from loaded_ranges
+          where group_id = $1 order by first_id'''
+      rows = await conn.fetch(sql, group_id)
+    return find_holes(
+      [tuple(r) for r in rows],
+      group['loaded_first_id'], group['loaded_last_id'],
+    )
+
+  async def stored_msgids(self, group_id: int, first: int, last: int) -> set[int]:
+    async with self.get_conn() as conn:
+      sql = '''\
+          select msgid from messages
+          where group_id = $1 and msgid between $2 and $3'''
+      return {r['msgid'] for r in await conn.fetch(sql, group_id, first, last)}
+
+  async def get_senders(self, group_id: int, msgids: list[int]) -> dict[int, int]:
+    '''msgid -> from_user of indexed messages'''
+    async with self.get_conn() as conn:
+      sql = '''\
+          select msgid, from_user from messages
+          where group_id = $1 and msgid = any($2::bigint[])'''
+      rows = await conn.fetch(sql, group_id, msgids)
+      return {r['msgid']: r['from_user'] for r in rows}
+
+  async def get_msgid_window(self, group_id: int, since: datetime.datetime):
+    '''the lowest and highest stored message ids since a time'''
+    async with self.get_conn() as conn:
+      sql = '''\
+          select min(msgid), max(msgid) from messages
+          where group_id = $1 and created_at >= $2'''
+      return tuple(await conn.fetchrow(sql, group_id, since))
+
+  async def get_msg_digests(
+    self, group_id: int, first: int, last: int, since: datetime.datetime,
+  ) -> dict[int, asyncpg.Record]:
+    '''msgid -> (updated_at, md5 of text without OCR results)'''
+    async with self.get_conn() as conn:
+      # OCR results are appended last, after an "[image]" line
+      sql = r'''
+          select msgid, updated_at,
+            md5(regexp_replace(text, '(^|\n)\[image\]\n.*$', '')) as digest
+          from messages
+          where group_id = $1 and msgid between $2 and $3 and created_at >= $4'''
+      rows = await conn.fetch(sql, group_id, first, last, since)
+      return {r['msgid']: r for r in rows}
 
   @contextlib.asynccontextmanager
   async def get_conn(self):
     for i in range(5):
       try:
-        async with self.pool.acquire() as conn, conn.transaction():
-          yield conn
+        st = time.monotonic()
+        async with self.pool.acquire() as conn:
+          metrics.db_pool_acquire_seconds.observe(time.monotonic() - st)
+          async with conn.transaction():
+            yield conn
         break
       except FileNotFoundError:
         if i < 4:
@@ -148,44 +492,31 @@ class PostgreStore:
 
     ret = []
     now = datetime.datetime.now().astimezone()
-    # we search backwards, so we start in "end" year or current year
-    if q.end:
-      this_year = min(q.end, now).year
-    else:
-      this_year = now.year
-
-    while True:
-      this_year_start = datetime.datetime(this_year, 1, 1).astimezone()
-      next_year_start = datetime.datetime(this_year+1, 1, 1).astimezone()
-      logger.debug('this_year_start=%s, next_year_start=%s, q.end=%s', this_year_start, next_year_start, q.end)
-
-      if q.end:
-        date_end = min(q.end, next_year_start)
-      else:
-        date_end = next_year_start
-      if q.start:
-        date_start = max(q.start, this_year_start)
-      else:
-        date_start = this_year_start
-
-      if date_start > date_end:
+    # we search backwards, partition by partition, starting from the one
+    # containing "end" or now
+    latest = min(q.end, now) if q.end else now
+    for p in self.partitions.partitions:
+      if p.start >= latest:
+        continue
+      if q.start and p.end <= q.start:
         break
+      date_start = max(q.start, p.start) if q.start else p.start
+      date_end = min(q.end, p.end) if q.end else p.end
+      logger.debug('searching partition %s in [%s, %s)', p.name, date_start, date_end)
 
-      ret += await self._search_one_year(
-        q, date_start, date_end,
+      ret += await self._search_one_partition(
+        q, p.name, date_start, date_end,
         self.SEARCH_LIMIT - len(ret),
       )
-
-      if len(ret) >= self.SEARCH_LIMIT or date_start < self.earliest_time:
+      if len(ret) >= self.SEARCH_LIMIT:
         break
 
-      this_year -= 1
-
     return groupinfo, ret
 
-  async def _search_one_year(
+  async def _search_one_partition(
     self,
     q: SearchQuery,
+    partition: str,
     date_start: datetime.datetime,
     date_end: datetime.datetime,
     limit: int,
@@ -194,7 +525,11 @@ class PostgreStore:
       # run a subquery to highlight because it would highlight all
       # matched rows (ignoring limits) otherwise
       common_cols = 'msgid, group_id, from_user, from_user_name, created_at, updated_at'
-      sql = '''select {0}, text from messages where 1 = 1'''
+      # query the partition itself so its indexes are planned for directly.
+      # With message_group_idx (text, group_id, created_at), the group and
+      # time conditions below are evaluated in the full-text index scan, so
+      # only matches in the group are fetched and sorted
+      sql = f'''select {{0}}, text from "{partition}" where 1 = 1'''
       highlight = None
       params = []
       if q.group:
@@ -212,7 +547,7 @@ class PostgreStore:
         sql += f''' and from_user = ${len(params)+1}'''
         params.append(q.sender)
 
-      sql += f''' and created_at > ${len(params)+1}'''
+      sql += f''' and created_at >= ${len(params)+1}'''
       params.append(date_start)
       sql += f''' and created_at < ${len(params)+1}'''
       params.append(date_end)
@@ -222,7 +557,8 @@ class PostgreStore:
         sql = f'select {{0}}, {highlight} from ({sql}) as t'
       sql = sql.format(common_cols)
       logger.debug('searching: %s: %s', sql, params)
-      rows = await conn.fetch(sql, *params)
+      with metrics.search_partition_seconds.labels(partition).time():
+        rows = await conn.fetch(sql, *params)
       return rows
 
   async def get_groups(self):
@@ -0,0 +1,138 @@
+import re
+import time
+import asyncio
+import logging
+from typing import Callable, Awaitable, Literal, Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable[None]]
+QueuePolicy = Literal['drop_new', 'drop_oldest']
+
+# references to groups, which would point at other patterns' groups once
+# patterns are combined
+_GROUP_REF = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+def _combinable(pattern: re.Pattern) -> bool:
+  '''whether a pattern means the same as an alternative of a combined one'''
+  # named groups may clash with those of other patterns
+  if pattern.groupindex or _GROUP_REF.search(pattern.pattern):
+    return False
+  try:
+    # e.g. global inline flags are only allowed at the start
+    re.compile(f'(?:{pattern.pattern})')
+  except re.error:
+    return False
+  return True
+
+class PluginPool:
+  '''run the message handlers of a plugin with a bounded number of workers
+
+  At most `queue_size` messages wait for a worker; beyond that either the new
+  message or the oldest waiting one is dropped, according to `policy`.
+  Several workers by default, so that one slow command doesn't hold up the
+  others of the same plugin.
+  '''
+
+  DEFAULT_WORKERS = 4
+
+  def __init__(
+    self, name: str, workers: int = DEFAULT_WORKERS, queue_size: int = 100,
+    policy: QueuePolicy = 'drop_new',
+  ) -> None:
+    if policy not in ('drop_new', 'drop_oldest'):
+      raise ValueError(f'bad queue policy: {policy!r}')
+    self.name = name
+    self.workers = workers
+    self.policy = policy
+    self._queue: asyncio.Queue[tuple[Handler, object]] = asyncio.Queue(queue_size)
+    self._tasks: list[asyncio.Task] = []
+    metrics.register_plugin_pool(name, self)
+
+  def qsize(self) -> int:
+    return self._queue.qsize()
+
+  def submit(self, handler: Handler, event) -> None:
+    if not self._tasks:
+      self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    try:
+      self._queue.put_nowait((handler, event))
+      return
+    except asyncio.QueueFull:
+      pass
+
+    metrics.plugin_messages.labels(self.name, 'dropped').inc()
+    if self.policy == 'drop_oldest':
+      self._queue.get_nowait()
+      self._queue.task_done()
+      self._queue.put_nowait((handler, event))
+      logger.warning('plugin %s is busy, dropped its oldest waiting message', self.name)
+    else:
+      logger.warning('plugin %s is busy, dropped a message', self.name)
+
+  async def _worker(self) -> None:
+    while True:
+      handler, event = await self._queue.get()
+      st = time.monotonic()
+      try:
+        await handler(event)
+        metrics.plugin_messages.labels(self.name, 'handled').inc()
+      except Exception:
+        metrics.plugin_messages.labels(self.name, 'error').inc()
+        logger.exception('plugin %s failed to handle a message', self.name)
+      finally:
+        metrics.plugin_handler_seconds.labels(self.name).observe(time.monotonic() - st)
+        self._queue.task_done()
+
+  def close(self) -> None:
+    for t in self._tasks:
+      t.cancel()
+    self._tasks = []
+
+class MsgDispatcher:
+  '''hand messages to the handlers whose patterns fully match their text
+
+  Patterns are combined into one regex that is tried first, so that most
+  messages are rejected with a single match. Patterns that would change
+  meaning when combined, e.g. with backreferences, are matched on their own.
+  Handlers run in the pool of their plugin and never block the caller.
+  '''
+
+  def __init__(self) -> None:
+    self.pools: dict[str, PluginPool] = {}
+    # (handler, pattern, pool, whether the pattern is in the prefilter)
+    self._handlers: list[tuple[Handler, re.Pattern, PluginPool, bool]] = []
+    self._prefilter: Optional[re.Pattern] = None
+
+  def add_pool(self, pool: PluginPool) -> None:
+    self.pools[pool.name] = pool
+
+  def add_handler(self, handler: Handler, pattern: str, plugin: str) -> None:
+    pool = self.pools.get(plugin)
+    if pool is None:
+      pool = self.pools[plugin] = PluginPool(plugin)
+    compiled = re.compile(pattern)
+    combinable = _combinable(compiled)
+    if not combinable:
+      logger.info('pattern %r of plugin %s is matched on its own', pattern, plugin)
+    self._handlers.append((handler, compiled, pool, combinable))
+    self._prefilter = self._build_prefilter()
+
+  def _build_prefilter(self) -> Optional[re.Pattern]:
+    patterns = [p.pattern for _, p, _, combinable in self._handlers if combinable]
+    if not patterns:
+      return None
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+  def dispatch(self, event, text: str) -> None:
+    if not self._handlers:
+      return
+    prefiltered = self._prefilter is not None and self._prefilter.fullmatch(text)
+    for handler, pattern, pool, combinable in self._handlers:
+      if combinable and not prefiltered:
+        continue
+      if pattern.fullmatch(text):
+        pool.submit(handler, event)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Iterable
+
+from .ctxvars import msg_source
+from .scheduler import Priority
+from .util import UpdateLoaded
+
+logger = logging.getLogger(__name__)
+
+Range = tuple[int, int]
+
+def merge_ranges(ranges: Iterable[Range]) -> list[Range]:
+  '''merge overlapping or adjacent inclusive ranges'''
+  ret = []
+  for first, last in sorted(ranges):
+    if ret and first <= ret[-1][1] + 1:
+      if last > ret[-1][1]:
+        ret[-1] = ret[-1][0], last
+    else:
+      ret.append((first, last))
+  return ret
+
+def find_holes(ranges: Iterable[Range], first: int, last: int) -> list[Range]:
+  '''parts of [first, last] not covered by ranges'''
+  ret = []
+  next_id = first
+  for a, b in merge_ranges(ranges):
+    if b < next_id:
+      continue
+    if a > last:
+      break
+    if a > next_id:
+      ret.append((next_id, a - 1))
+    next_id = b + 1
+  if next_id <= last:
+    ret.append((next_id, last))
+  return ret
+
+def subtract_ids(first: int, last: int, ids: Iterable[int]) -> list[Range]:
+  '''split [first, last] into ranges that don't contain ids'''
+  return find_holes([(i, i) for i in ids], first, last)
+
+class GapRepairer:
+  '''fetch messages missing inside the loaded window of groups
+
+  Every batch written records the id range it covers in loaded_ranges.
+  Holes between those ranges are messages that were never indexed (e.g. a
+  crash mid-batch or a message that failed to format). They are
+  fetched by id, skipping ids that are already stored, at most `max_ids`
+  ids looked at per group each round. Ranges of groups indexed before
+  loaded_ranges existed are seeded by PostgreStore.setup.
+  '''
+
+  def __init__(self, dbstore, scheduler, groups, interval: float = 3600, max_ids: int = 1000) -> None:
+    '''groups: a list of (entity, use_ocr)'''
+    self.dbstore = dbstore
+    self.scheduler = scheduler
+    self.groups = groups
+    self.interval = interval
+    self.max_ids = max_ids
+
+  async def run(self) -> None:
+    msg_source.set('repair')
+    while True:
+      for entity, use_ocr in self.groups:
+        try:
+          await self.repair_group(entity, use_ocr)
+        except Exception:
+          logger.exception('failed to repair group %s', entity.id)
+      await asyncio.sleep(self.interval)
+
+  async def repair_group(self, entity, use_ocr) -> None:
+    group_id = entity.id
+    holes = await self.dbstore.find_holes(group_id)
+    if not holes:
+      return
+    logger.info('group %s has %d holes in its loaded ranges', group_id, len(holes))
+
+    budget = self.max_ids
+    for first, last in holes:
+      while first <= last and budget > 0:
+        end = min(last, first + 99, first + budget - 1)
+        stored = await self.dbstore.stored_msgids(group_id, first, end)
+        ids = [i for i in range(first, end + 1) if i not in stored]
+        # charge the whole span so that holes of stored ids (recorded as
+        # loaded below) don't make a round unbounded
+        budget -= end - first + 1
+        if ids:
+          msgs = await self.scheduler.get_messages(
+            group_id, Priority.repair, entity, ids=ids)
+          msgs = [m for m in msgs if m is not None]
+          logger.info('repairing group %s: %d of %d missing ids found',
+                      group_id, len(msgs), len(ids))
+        else:
+          msgs = []
+
+        if msgs:
+          await self.dbstore.insert_messages(
+            msgs, UpdateLoaded.update_none, use_ocr = use_ocr,
+            covered = (first, end),
+          )
+        else:
+          # all deleted (or already stored)
+          await self.dbstore.record_loaded(group_id, first, end)
+        first = end + 1
+
+      if budget <= 0:
+        break
@@ -1,83 +1,202 @@
 import logging
 import asyncio
+import time
 
 from .ctxvars import msg_source
 from .util import UpdateLoaded
+from .scheduler import Priority
 
 logger = logging.getLogger(__name__)
 
-async def timed_get_messages(client, *args, **kwargs):
-  while True:
-    try:
-      return await asyncio.wait_for(client.get_messages(*args, **kwargs), 60)
-    except asyncio.TimeoutError:
-      logger.error('timed out getting a message, retrying: %r, %r', args, kwargs)
-      await asyncio.sleep(1)
-    except Exception:
-      logger.exception('error in get_messages')
-      await asyncio.sleep(1)
-
 class GroupHistoryIndexer:
   entity = None
+  MIN_PAGE_SIZE = 20
+  MAX_PAGE_SIZE = 100
 
-  def __init__(self, entity, group_info, use_ocr):
+  def __init__(self, entity, group_info, use_ocr, scheduler, prefetch=2, backfill_workers=1):
+    '''prefetch: the number of fetched pages that may wait to be written
+    backfill_workers: the number of id ranges of older history to fetch in parallel'''
     self.group_id = entity.id
+    self.scheduler = scheduler
     self.entity = entity
     self.group_info = group_info
     self.use_ocr = use_ocr
+    self.prefetch = prefetch
+    self.backfill_workers = backfill_workers
+    self.page_size = 50
 
-  async def run(self, client, dbstore, callback):
+  async def run(self, dbstore, callback):
     msg_source.set('history')
     group_info = self.group_info
     if group_info['loaded_last_id'] is None:
       first_id = 0
-      msgs = await timed_get_messages(client, self.entity, limit=2)
+      msgs = await self.scheduler.get_messages(
+        self.group_id, Priority.forward, self.entity, limit=2)
       last_id = msgs[-1].id
     else:
       first_id = self.group_info['loaded_first_id']
       last_id = self.group_info['loaded_last_id']
+    self._progress('forward', first_id=first_id, last_id=last_id)
 
     # going forward
-    while True:
-      msgs = await timed_get_messages(
-        client,
-        self.entity,
-        limit = 50,
-        # from current to newer (or latest)
-        reverse = True,
-        min_id = last_id,
-      )
-      if not msgs:
-        break
-
+    # pages are written in the order they are fetched, so checkpoints only
+    # move after everything before them has been committed
+    async for msgs in self._pipelined(self._pages_forward(last_id)):
       if not first_id:
         update_loaded = UpdateLoaded.update_both
         first_id = msgs[0].id
       else:
         update_loaded = UpdateLoaded.update_last
-        last_id = msgs[-1].id
-      await dbstore.insert_messages(msgs, update_loaded, use_ocr = self.use_ocr)
+      # ids between pages are deleted messages
+      await dbstore.insert_messages(
+        msgs, update_loaded, use_ocr = self.use_ocr,
+        covered = (last_id + 1, msgs[-1].id),
+      )
+      last_id = msgs[-1].id
+      self._progress('forward', first_id=first_id, last_id=msgs[-1].id)
 
     logger.info('forward history index done for group %s', self.group_info['name'])
     callback()
 
     # going backward
     if first_id == 1:
+      self._progress('done')
       return
 
+    self._progress('backward')
+    # first_id is 0 if going forward found nothing, e.g. in a new group with
+    # one message; there are no ranges to split then
+    if self.backfill_workers > 1 and first_id > 1:
+      await self._backfill_parallel(dbstore, first_id)
+    else:
+      async for msgs in self._pipelined(self._pages_backward(first_id)):
+        await dbstore.insert_messages(
+          msgs, UpdateLoaded.update_first, use_ocr = self.use_ocr,
+          covered = (msgs[0].id, first_id - 1),
+        )
+        first_id = msgs[0].id
+        self._progress('backward', first_id=first_id)
+
+    logger.info('backward history index done for group %s', self.group_info['name'])
+    self._progress('done')
+
+  async def _backfill_parallel(self, dbstore, first_id):
+    ranges = await dbstore.get_backfill_ranges(self.group_id)
+    if not ranges:
+      n = self.backfill_workers
+      step = -(-(first_id - 1) // n)
+      ranges = [{
+        'range_start': start,
+        'range_end': min(start + step, first_id),
+        'cursor': min(start + step, first_id),
+      } for start in range(1, first_id, step)]
+      await dbstore.create_backfill_ranges(self.group_id, ranges)
+    logger.info('backfilling group %s in %d ranges', self.group_info['name'], len(ranges))
+
+    await asyncio.gather(*(
+      self._backfill_range(dbstore, ranges, r)
+      for r in ranges if r['cursor'] > r['range_start']
+    ))
+    await dbstore.delete_backfill_ranges(self.group_id)
+
+  async def _backfill_range(self, dbstore, ranges, r):
+    while True:
+      msgs = await self.scheduler.get_messages(
+        self.group_id, Priority.backward, self.entity,
+        limit = self.MAX_PAGE_SIZE,
+        max_id = r['cursor'],
+        min_id = r['range_start'] - 1,
+      )
+      if msgs:
+        msgs = msgs[::-1]
+        await dbstore.insert_messages(
+          msgs, UpdateLoaded.update_none, use_ocr = self.use_ocr,
+          covered = (msgs[0].id, r['cursor'] - 1),
+        )
+        r['cursor'] = msgs[0].id
+      else:
+        await dbstore.record_loaded(self.group_id, r['range_start'], r['cursor'] - 1)
+        r['cursor'] = r['range_start']
+
+      first_id = self._merged_first_id(ranges)
+      await dbstore.backfill_progress(self.group_id, r['range_start'], r['cursor'], first_id)
+      self._progress('backward', first_id=first_id)
+      if not msgs:
+        break
+
+  @staticmethod
+  def _merged_first_id(ranges):
+    '''the lowest id down to which everything has been indexed'''
+    first_id = None
+    for r in sorted(ranges, key=lambda r: r['range_end'], reverse=True):
+      first_id = r['cursor']
+      if r['cursor'] > r['range_start']:
+        break
+    return first_id
+
+  def _progress(self, phase, **kwargs):
+    self.scheduler.set_progress(
+      self.group_id, name=self.group_info['name'], phase=phase, **kwargs)
+
+  async def _pipelined(self, pages):
+    '''fetch pages in the background while the caller processes earlier ones'''
+    queue = asyncio.Queue(self.prefetch)
+
+    async def producer():
+      try:
+        async for page in pages:
+          await queue.put(page)
+        await queue.put(None)
+      except Exception as e:
+        await queue.put(e)
+
+    task = asyncio.create_task(producer())
+    try:
+      while True:
+        page = await queue.get()
+        if page is None:
+          break
+        if isinstance(page, Exception):
+          raise page
+        yield page
+    finally:
+      task.cancel()
+
+  async def _fetch_page(self, priority, **kwargs):
+    st = time.monotonic()
+    limit = self.page_size
+    msgs = await self.scheduler.get_messages(
+      self.group_id, priority, self.entity, limit=limit, **kwargs)
+    elapsed = time.monotonic() - st
+    # grow pages while Telegram is quick, shrink them when it's slow
+    if len(msgs) == limit and elapsed < 2:
+      self.page_size = min(self.MAX_PAGE_SIZE, limit + 25)
+    elif elapsed > 10:
+      self.page_size = max(self.MIN_PAGE_SIZE, limit // 2)
+    return msgs
+
+  async def _pages_forward(self, last_id):
     while True:
-      msgs = await timed_get_messages(
-        client,
-        self.entity,
-        limit = 50,
+      msgs = await self._fetch_page(
+        Priority.forward,
+        # from current to newer (or latest)
+        reverse = True,
+        min_id = last_id,
+      )
+      if not msgs:
+        break
+      last_id = msgs[-1].id
+      yield msgs
+
+  async def _pages_backward(self, first_id):
+    while True:
+      msgs = await self._fetch_page(
+        Priority.backward,
         # from current (or latest) to older
         max_id = first_id,
       )
       if not msgs:
         break
-
       msgs = msgs[::-1]
       first_id = msgs[0].id
-      await dbstore.insert_messages(msgs, UpdateLoaded.update_first, use_ocr = self.use_ocr)
-
-    logger.info('backward history index done for group %s', self.group_info['name'])
+      yield msgs
@@ -1,5 +1,6 @@
 import logging
 import asyncio
+import contextlib
 from typing import Optional
 
 import telethon
@@ -7,18 +8,46 @@ from telethon.tl import types
 
 import querytrans
 
+from .tracing import span
+
 logger = logging.getLogger(__name__)
 
 def text_to_query(s):
   return querytrans.transform(s)
 
-async def format_msg(msg, ocrsvc=None) -> Optional[str]:
-  try:
-    return await asyncio.wait_for(_format_msg(msg, ocrsvc=ocrsvc), 60)
-  except asyncio.TimeoutError:
-    logger.error('timed out formatting a message: %r', msg.to_dict())
+def has_image(msg) -> bool:
+  media = msg.media
+  return isinstance(media, types.MessageMediaPhoto) \
+    or (isinstance(media, types.MessageMediaDocument)
+        and media.document.mime_type.startswith('image/'))
+
+async def format_msgs(msgs, ocrsvc=None, concurrency=4) -> list[Optional[str]]:
+  '''format messages concurrently, at most `concurrency` at a time
+
+  Results are in the order of msgs.'''
+  limit = asyncio.Semaphore(concurrency)
+  return await asyncio.gather(*(
+    format_msg(msg, ocrsvc, limit=limit) for msg in msgs
+  ))
+
+async def format_msg(msg, ocrsvc=None, raise_ocr_error=False, limit=None) -> Optional[str]:
+  '''limit: a semaphore to acquire before formatting; waiting for it doesn't
+  count towards the timeout.
+
+  If formatting (i.e. OCR) times out, the text without OCR is returned,
+  unless raise_ocr_error is set, in which case the timeout is raised.'''
+  async with limit or contextlib.nullcontext():
+    try:
+      with span('format_msg', msgid=msg.id):
+        return await asyncio.wait_for(_format_msg(
+          msg, ocrsvc=ocrsvc, raise_ocr_error=raise_ocr_error), 60)
+    except asyncio.TimeoutError:
+      if raise_ocr_error:
+        raise
+      logger.error('timed out formatting a message, indexing it without OCR: %r', msg.to_dict())
+      return await _format_msg(msg)
 
-async def _format_msg(msg, ocrsvc=None) -> str:
+async def _format_msg(msg, ocrsvc=None, raise_ocr_error=False) -> str:
   if isinstance(msg, telethon.tl.patched.MessageService):
     # pinning or joining messages etc
     return
@@ -48,16 +77,15 @@ async def _format_msg(msg, ocrsvc=None) -> str:
       if getattr(a, 'performer', None) and getattr(a, 'title', None):
         text.append(f'[audio] {a.title} - {a.performer}')
 
-  if ocrsvc and (media := msg.media):
-    if isinstance(media, types.MessageMediaPhoto) \
-       or (isinstance(media, types.MessageMediaDocument)
-           and msg.media.document.mime_type.startswith('image/')):
-      try:
-        if ocr_text := await ocrsvc.ocr_img(media):
-          text.append('[image]')
-          text.extend(ocr_text)
-      except Exception as e:
-        logger.error('failed to do ocr: %r', e)
+  if ocrsvc and has_image(msg):
+    try:
+      if ocr_text := await ocrsvc.ocr_img(msg.media):
+        text.append('[image]')
+        text.extend(ocr_text)
+    except Exception as e:
+      if raise_ocr_error:
+        raise
+      logger.error('failed to do ocr: %r', e)
 
   text = '\n'.join(x for x in text if x)
 
@@ -0,0 +1,24 @@
+import io
+
+from PIL import Image
+
+def dhash(data: bytes, size: int = 8) -> int:
+  '''difference hash of an image, as a signed integer of size * size bits
+
+  The image is shrunk to (size + 1) x size grayscale pixels; each bit tells
+  whether a pixel is brighter than its right neighbour.'''
+  with Image.open(io.BytesIO(data)) as img:
+    pixels = list(
+      img.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+
+  h = 0
+  for row in range(size):
+    for col in range(size):
+      i = row * (size + 1) + col
+      h = (h << 1) | (pixels[i] > pixels[i + 1])
+
+  # fit into PostgreSQL bigint
+  bits = size * size
+  if h >= 1 << (bits - 1):
+    h -= 1 << bits
+  return h
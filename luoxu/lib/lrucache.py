@@ -0,0 +1,140 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Hashable
+
+_MISSING = object()
+
+class LRUCache:
+  '''A least-recently-used cache with per-entry TTL
+
+  All operations are O(1). Expired entries are dropped lazily when they are
+  looked up or reach the LRU end. If `weigher` is given, the sum of weights
+  of entries is kept under `maxweight` instead of counting entries.
+  '''
+
+  def __init__(
+    self,
+    maxsize: Optional[int] = 128,
+    ttl: Optional[float] = None,
+    *,
+    weigher: Optional[Callable[[Any], int]] = None,
+    maxweight: Optional[int] = None,
+  ) -> None:
+    self.maxsize = maxsize
+    self.default_ttl = ttl
+    self.weigher = weigher
+    self.maxweight = maxweight
+    # key -> (value, expires_at, weight)
+    self._data: OrderedDict[Hashable, tuple[Any, float, int]] = OrderedDict()
+    self._inflight: dict[Hashable, asyncio.Task] = {}
+    self.weight = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self) -> int:
+    return len(self._data)
+
+  def __contains__(self, key) -> bool:
+    return self._lookup(key) is not _MISSING
+
+  def _lookup(self, key):
+    try:
+      value, expires_at, _ = self._data[key]
+    except KeyError:
+      return _MISSING
+    if expires_at < time.monotonic():
+      self._remove(key)
+      return _MISSING
+    return value
+
+  def get(self, key, default=None):
+    value = self._lookup(key)
+    if value is _MISSING:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self._data.move_to_end(key)
+    return value
+
+  def __getitem__(self, key):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      raise KeyError(key)
+    return value
+
+  def __setitem__(self, key, value) -> None:
+    self.set(key, value)
+
+  def set(self, key, value, ttl: Optional[float] = None) -> None:
+    if ttl is None:
+      ttl = self.default_ttl
+    expires_at = time.monotonic() + ttl if ttl is not None else float('inf')
+    weight = self.weigher(value) if self.weigher else 1
+    if key in self._data:
+      self._remove(key)
+    self._data[key] = value, expires_at, weight
+    self.weight += weight
+    self._evict()
+
+  def __delitem__(self, key) -> None:
+    if key not in self._data:
+      raise KeyError(key)
+    self._remove(key)
+
+  def pop(self, key, default=None):
+    value = self._lookup(key)
+    if value is _MISSING:
+      return default
+    self._remove(key)
+    return value
+
+  def clear(self) -> None:
+    self._data.clear()
+    self.weight = 0
+
+  def _remove(self, key) -> None:
+    _, _, weight = self._data.pop(key)
+    self.weight -= weight
+
+  def _evict(self) -> None:
+    while self._data and (
+      (self.maxsize is not None and len(self._data) > self.maxsize)
+      or (self.maxweight is not None and self.weight > self.maxweight)
+    ):
+      key, (_, expires_at, weight) = self._data.popitem(last=False)
+      self.weight -= weight
+      if expires_at >= time.monotonic():
+        self.evictions += 1
+
+  async def get_or_load(
+    self, key, loader: Callable[[], Awaitable[Any]],
+    ttl: Optional[float] = None,
+  ):
+    '''get the value for key, or load and cache it
+
+    Concurrent calls for the same key share one load. Failed loads are not
+    cached, and a cancelled caller doesn't cancel the load for others.'''
+    value = self.get(key, _MISSING)
+    if value is not _MISSING:
+      return value
+
+    task = self._inflight.get(key)
+    if task is None:
+      task = asyncio.create_task(loader())
+      self._inflight[key] = task
+
+      def done(task):
+        if self._inflight.get(key) is task:
+          del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+          self.set(key, task.result(), ttl)
+      task.add_done_callback(done)
+    else:
+      # joining an in-flight load is a hit for the loader's purpose
+      self.misses -= 1
+      self.hits += 1
+
+    return await asyncio.shield(task)
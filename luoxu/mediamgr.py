@@ -1,45 +1,172 @@
+import os
 import asyncio
-import inspect
 import logging
+import tempfile
+import contextlib
+from typing import Optional
 
 from telethon.tl import types
 
-from .lib.expiringdict import ExpiringDict
 from .ctxvars import group_title
+from . import metrics
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
+def media_key(media) -> int:
+  if isinstance(media, types.MessageMediaPhoto):
+    return media.photo.id
+  else:
+    return media.document.id
+
+def _photo_size_bytes(s) -> Optional[int]:
+  if isinstance(s, types.PhotoSize):
+    return s.size
+  elif isinstance(s, types.PhotoSizeProgressive):
+    return max(s.sizes)
+  elif isinstance(s, types.PhotoCachedSize):
+    return len(s.bytes)
+  return None
+
+def media_size(media, thumb=None) -> Optional[int]:
+  '''the expected download size in bytes, if known'''
+  if thumb is not None:
+    return _photo_size_bytes(thumb)
+  if isinstance(media, types.MessageMediaPhoto):
+    sizes = [_photo_size_bytes(s) for s in media.photo.sizes]
+    return max((s for s in sizes if s is not None), default=None)
+  else:
+    return media.document.size
+
+def pick_photo_size(photo, min_size: int):
+  '''the smallest photo size whose longer side is at least min_size
+
+  Return None if that is the largest one (the default for downloading).'''
+  sizes = [
+    s for s in photo.sizes
+    if isinstance(s, (types.PhotoSize, types.PhotoSizeProgressive, types.PhotoCachedSize))
+  ]
+  if not sizes or min_size <= 0:
+    return None
+  sizes.sort(key=lambda s: s.w * s.h)
+  for s in sizes[:-1]:
+    if max(s.w, s.h) >= min_size:
+      return s
+  return None
+
+class _Entry:
+  def __init__(self) -> None:
+    self.task: Optional[asyncio.Task] = None
+    self.refs = 0
+    # bytes reserved in memory; 0 if spilled to disk
+    self.mem_size = 0
+    self.path: Optional[str] = None
+
 class MediaMgr:
-  def __init__(self, client):
-    self.client = client
-    self._media_cache = ExpiringDict(3600)
-    self._media_cache_lock = asyncio.Lock()
+  '''download media for concurrent consumers
+
+  A download is shared by all consumers that ask for the same media while it
+  is in use, and dropped as soon as the last of them is done. Payloads that
+  are large or don't fit in the memory budget are downloaded to temporary
+  files instead.
+  '''
 
-  async def get_media(self, media):
-    if isinstance(media, types.MessageMediaPhoto):
-      key = media.photo.id
+  def __init__(
+    self, client,
+    memory_budget: int = 64 * 1024 * 1024,
+    spill_size: int = 4 * 1024 * 1024,
+    tmpdir: Optional[str] = None,
+    concurrency: int = 0,
+  ) -> None:
+    '''concurrency: the maximum number of concurrent downloads; 0 means unlimited'''
+    self.client = client
+    if concurrency:
+      self._limit = asyncio.Semaphore(concurrency)
     else:
-      key = media.document.id
+      self._limit = contextlib.nullcontext()
+    self.memory_budget = memory_budget
+    self.spill_size = spill_size
+    self.tmpdir = tmpdir
+    self._entries: dict[tuple[int, Optional[str]], _Entry] = {}
+    self._mem_used = 0
 
-    async with self._media_cache_lock:
-      cached = self._media_cache.get(key)
-      if cached is None:
-        # coroutine cannot be awaited twice, but task can
-        fu = asyncio.create_task(self._download_media(media))
-        self._media_cache[key] = fu
+  @contextlib.asynccontextmanager
+  async def open_media(self, media, thumb=None):
+    '''yield the media content as bytes or as a file object opened for reading
 
-    if cached is None:
-      return await fu
+    thumb: a photo size to download instead of the largest one'''
+    key = media_key(media), thumb.type if thumb else None
+    entry = self._entries.get(key)
+    if entry is None:
+      metrics.cache_requests.labels('media', 'miss').inc()
+      entry = self._entries[key] = _Entry()
+      self._reserve(entry, media_size(media, thumb))
+      # coroutine cannot be awaited twice, but task can
+      entry.task = asyncio.create_task(self._download_media(media, thumb, entry))
     else:
-      if inspect.isawaitable(cached):
-        return await cached
+      metrics.cache_requests.labels('media', 'hit').inc()
+
+    entry.refs += 1
+    try:
+      data = await asyncio.shield(entry.task)
+      if isinstance(data, bytes):
+        yield data
       else:
-        return cached
+        with open(data, 'rb') as f:
+          yield f
+    finally:
+      entry.refs -= 1
+      if entry.refs == 0:
+        self._release(key, entry)
 
-  async def _download_media(self, media):
-    if isinstance(media, types.MessageMediaPhoto):
-      key = media.photo.id
+  def _reserve(self, entry: _Entry, size: Optional[int]) -> None:
+    if size is None or size > self.spill_size \
+       or self._mem_used + size > self.memory_budget:
+      fd, entry.path = tempfile.mkstemp(prefix='luoxu-media-', dir=self.tmpdir)
+      os.close(fd)
     else:
-      key = media.document.id
-    logger.info('<%s> Downloading media %s...', group_title.get(), key)
-    return await self.client.download_media(media, file=bytes)
+      entry.mem_size = size
+      self._mem_used += size
+    self._update_metrics()
+
+  def _release(self, key, entry: _Entry) -> None:
+    if self._entries.get(key) is entry:
+      del self._entries[key]
+    if not entry.task.done():
+      entry.task.cancel()
+    self._mem_used -= entry.mem_size
+    entry.mem_size = 0
+    if entry.path:
+      with contextlib.suppress(FileNotFoundError):
+        os.unlink(entry.path)
+    self._update_metrics()
+
+  def _update_metrics(self) -> None:
+    metrics.media_cache_entries.labels('memory').set(
+      sum(1 for e in self._entries.values() if not e.path))
+    metrics.media_cache_entries.labels('disk').set(
+      sum(1 for e in self._entries.values() if e.path))
+    metrics.media_cache_bytes.set(self._mem_used)
+
+  async def _download_media(self, media, thumb, entry: _Entry):
+    key = media_key(media)
+    thumb_type = thumb.type if thumb else None
+    async with self._limit:
+      return await self._download_media_limited(media, key, thumb_type, entry)
+
+  async def _download_media_limited(self, media, key, thumb_type, entry: _Entry):
+    logger.info('<%s> Downloading media %s (size %s)...', group_title.get(), key, thumb_type or 'largest')
+    with span('download_media', media_id=key, thumb=thumb_type, spilled=bool(entry.path)) as s:
+      if entry.path:
+        await self.client.download_media(media, file=entry.path, thumb=thumb_type)
+        if s:
+          s.set(size=os.path.getsize(entry.path))
+        return entry.path
+      else:
+        data = await self.client.download_media(media, file=bytes, thumb=thumb_type)
+        if s:
+          s.set(size=len(data))
+        # correct our estimation
+        self._mem_used += len(data) - entry.mem_size
+        entry.mem_size = len(data)
+        return data
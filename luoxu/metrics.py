@@ -0,0 +1,378 @@
+'''
+A minimal Prometheus-compatible metrics registry.
+
+Metrics are defined at module level here and updated from wherever the event
+happens; `render()` produces the text exposition format served at /metrics.
+'''
+
+import time
+import math
+import contextlib
+from typing import Callable, Optional
+
+DEFAULT_BUCKETS = (
+  0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+LAG_BUCKETS = (
+  0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600, 86400, 86400 * 30,
+)
+
+_registry = []
+
+def _escape(v) -> str:
+  return str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _format_labels(names, values, extra=()) -> str:
+  pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+  pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+  if not pairs:
+    return ''
+  return '{' + ','.join(pairs) + '}'
+
+def _format_value(v) -> str:
+  if v == math.inf:
+    return '+Inf'
+  if isinstance(v, float) and v.is_integer():
+    return str(int(v))
+  return str(v)
+
+class _Metric:
+  type: str
+
+  def __init__(
+    self, name: str, help: str, labelnames=(),
+    func: Optional[Callable[[], dict]] = None,
+  ) -> None:
+    '''func, if given, is called on render and returns {labelvalues: value}'''
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.func = func
+    self._children = {}
+    _registry.append(self)
+
+  def labels(self, *values):
+    if len(values) != len(self.labelnames):
+      raise ValueError(f'{self.name} expects labels {self.labelnames}, got {values!r}')
+    values = tuple(str(v) for v in values)
+    try:
+      return self._children[values]
+    except KeyError:
+      child = self._children[values] = self._new_child()
+      return child
+
+  def _new_child(self):
+    raise NotImplementedError
+
+  def _samples(self):
+    raise NotImplementedError
+
+  def render(self) -> list[str]:
+    lines = [
+      f'# HELP {self.name} {self.help}',
+      f'# TYPE {self.name} {self.type}',
+    ]
+    for suffix, values, extra, v in self._samples():
+      labels = _format_labels(self.labelnames, values, extra)
+      lines.append(f'{self.name}{suffix}{labels} {_format_value(v)}')
+    return lines
+
+class _Value:
+  def __init__(self) -> None:
+    self.value = 0.0
+
+  def inc(self, amount: float = 1) -> None:
+    self.value += amount
+
+  def dec(self, amount: float = 1) -> None:
+    self.value -= amount
+
+  def set(self, value: float) -> None:
+    self.value = value
+
+class Counter(_Metric):
+  type = 'counter'
+
+  def _new_child(self):
+    return _Value()
+
+  def inc(self, amount: float = 1) -> None:
+    self.labels().inc(amount)
+
+  def _samples(self):
+    if self.func is not None:
+      for values, v in self.func().items():
+        yield '_total', values, (), v
+    for values, c in self._children.items():
+      yield '_total', values, (), c.value
+
+class Gauge(_Metric):
+  type = 'gauge'
+
+  def _new_child(self):
+    return _Value()
+
+  def inc(self, amount: float = 1) -> None:
+    self.labels().inc(amount)
+
+  def dec(self, amount: float = 1) -> None:
+    self.labels().dec(amount)
+
+  def set(self, value: float) -> None:
+    self.labels().set(value)
+
+  @contextlib.contextmanager
+  def track_inprogress(self, *values):
+    child = self.labels(*values)
+    child.inc()
+    try:
+      yield
+    finally:
+      child.dec()
+
+  def _samples(self):
+    if self.func is not None:
+      for values, v in self.func().items():
+        yield '', values, (), v
+    for values, c in self._children.items():
+      yield '', values, (), c.value
+
+class _HistogramValue:
+  def __init__(self, buckets) -> None:
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, v: float) -> None:
+    self.sum += v
+    self.count += 1
+    for i, b in enumerate(self.buckets):
+      if v <= b:
+        self.counts[i] += 1
+        break
+
+  @contextlib.contextmanager
+  def time(self):
+    st = time.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(time.monotonic() - st)
+
+class Histogram(_Metric):
+  type = 'histogram'
+
+  def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+    super().__init__(name, help, labelnames)
+    self.buckets = tuple(buckets) + (math.inf,)
+
+  def _new_child(self):
+    return _HistogramValue(self.buckets)
+
+  def observe(self, v: float) -> None:
+    self.labels().observe(v)
+
+  def time(self):
+    return self.labels().time()
+
+  def _samples(self):
+    for values, h in self._children.items():
+      acc = 0
+      for b, n in zip(self.buckets, h.counts):
+        acc += n
+        yield '_bucket', values, (('le', _format_value(float(b))),), acc
+      yield '_sum', values, (), h.sum
+      yield '_count', values, (), h.count
+
+def render() -> str:
+  lines = []
+  for m in _registry:
+    lines.extend(m.render())
+  return '\n'.join(lines) + '\n'
+
+http_request_seconds = Histogram(
+  'luoxu_http_request_duration_seconds',
+  'Time spent handling API requests',
+  ['route'],
+)
+search_partition_seconds = Histogram(
+  'luoxu_search_partition_duration_seconds',
+  'Time spent searching one partition',
+  ['partition'],
+)
+ingested_messages = Counter(
+  'luoxu_ingested_messages',
+  'Messages written to the database',
+  ['group', 'source'],
+)
+ingest_lag_seconds = Histogram(
+  'luoxu_ingest_lag_seconds',
+  'Time from message date to database commit',
+  ['source'],
+  buckets = LAG_BUCKETS,
+)
+get_messages_seconds = Histogram(
+  'luoxu_get_messages_duration_seconds',
+  'Latency of get_messages requests to Telegram',
+)
+get_messages_errors = Counter(
+  'luoxu_get_messages_errors',
+  'Failed get_messages requests to Telegram',
+  ['kind'],
+)
+floodwait_seconds = Counter(
+  'luoxu_floodwait_seconds',
+  'Seconds Telegram asked us to wait by FloodWaitError',
+)
+ocr_inprogress = Gauge(
+  'luoxu_ocr_inprogress',
+  'Images waiting for download or OCR',
+)
+ocr_seconds = Histogram(
+  'luoxu_ocr_duration_seconds',
+  'Time spent in the OCR service',
+)
+ocr_jobs = Counter(
+  'luoxu_ocr_jobs',
+  'Deferred OCR jobs by event',
+  ['event'],
+)
+ocr_queue_depth = Gauge(
+  'luoxu_ocr_queue_depth',
+  'Deferred OCR jobs in the database, as of the last poll',
+)
+_caches = {}
+
+def register_cache(name: str, cache) -> None:
+  '''export hit / miss / eviction statistics of an LRUCache'''
+  _caches[name] = cache
+
+def _collect_cache_requests():
+  ret = {}
+  for name, cache in _caches.items():
+    ret[(name, 'hit')] = cache.hits
+    ret[(name, 'miss')] = cache.misses
+  return ret
+
+cache_requests = Counter(
+  'luoxu_cache_requests',
+  'Cache lookups',
+  ['cache', 'result'],
+  func = _collect_cache_requests,
+)
+cache_evictions = Counter(
+  'luoxu_cache_evictions',
+  'Cache entries evicted before expiry',
+  ['cache'],
+  func = lambda: {(name,): c.evictions for name, c in _caches.items()},
+)
+media_cache_entries = Gauge(
+  'luoxu_media_cache_entries',
+  'Media downloads in use',
+  ['location'],
+)
+media_cache_bytes = Gauge(
+  'luoxu_media_cache_bytes',
+  'Memory used by media downloads in use',
+)
+db_pool_acquire_seconds = Histogram(
+  'luoxu_db_pool_acquire_duration_seconds',
+  'Time spent waiting for a database connection',
+)
+
+_db_pool = None
+
+def _collect_db_pool():
+  if _db_pool is None:
+    return {}
+  return {
+    ('size',): _db_pool.get_size(),
+    ('idle',): _db_pool.get_idle_size(),
+    ('max',): _db_pool.get_max_size(),
+  }
+
+db_pool_connections = Gauge(
+  'luoxu_db_pool_connections',
+  'Connections in the database pool',
+  ['state'],
+  func = _collect_db_pool,
+)
+
+def register_db_pool(pool) -> None:
+  global _db_pool
+  _db_pool = pool
+
+_history_progress = {}
+
+def register_history_progress(progress: dict) -> None:
+  global _history_progress
+  _history_progress = progress
+
+def _collect_history_ids():
+  ret = {}
+  for group_id, p in _history_progress.items():
+    for end in ['first_id', 'last_id']:
+      if p.get(end) is not None:
+        ret[(group_id, p.get('name'), end)] = p[end]
+  return ret
+
+history_loaded_id = Gauge(
+  'luoxu_history_loaded_id',
+  'Message ids up to which group history has been indexed',
+  ['group', 'name', 'end'],
+  func = _collect_history_ids,
+)
+history_phase = Gauge(
+  'luoxu_history_phase',
+  'Current history indexing phase of groups',
+  ['group', 'name', 'phase'],
+  func = lambda: {
+    (group_id, p.get('name'), p['phase']): 1
+    for group_id, p in _history_progress.items() if 'phase' in p
+  },
+)
+
+_plugin_pools = {}
+
+def register_plugin_pool(name: str, pool) -> None:
+  _plugin_pools[name] = pool
+
+plugin_handler_seconds = Histogram(
+  'luoxu_plugin_handler_duration_seconds',
+  'Time spent by plugins handling a message',
+  ['plugin'],
+)
+plugin_messages = Counter(
+  'luoxu_plugin_messages',
+  'Messages dispatched to plugins by outcome',
+  ['plugin', 'event'],
+)
+plugin_queue_depth = Gauge(
+  'luoxu_plugin_queue_depth',
+  'Messages waiting for plugin workers',
+  ['plugin'],
+  func = lambda: {(name,): p.qsize() for name, p in _plugin_pools.items()},
+)
+
+_spool = None
+
+def register_spool(spool) -> None:
+  global _spool
+  _spool = spool
+
+spool_bytes = Gauge(
+  'luoxu_spool_bytes',
+  'Size of the local spool of batches not yet written to the database',
+  func = lambda: {(): _spool.size()} if _spool else {},
+)
+spool_replay_lag_seconds = Gauge(
+  'luoxu_spool_replay_lag_seconds',
+  'Age of the oldest spooled batch not yet replayed',
+  func = lambda: {(): time.time() - _spool.oldest} if _spool and _spool.oldest else {},
+)
+spool_records = Counter(
+  'luoxu_spool_records',
+  'Batches written to or replayed from the local spool',
+  ['event'],
+)
@@ -1,22 +1,64 @@
 import logging
-import inspect
 import asyncio
+import contextlib
 import time
 
 import aiohttp
 from telethon.tl import types
 
-from .lib.expiringdict import ExpiringDict
+from .lib.lrucache import LRUCache
+from .mediamgr import pick_photo_size, media_key
 from .ctxvars import group_title
+from . import metrics
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
+class OCRFailed(Exception):
+  pass
+
 class OCRService:
-  def __init__(self, mediamgr, ocr_url, ocr_socket=None):
-    self._ocr_cache = ExpiringDict(3600)
-    self._ocr_cache_lock = asyncio.Lock()
+  # the pigeonhole bound of searching by four 16-bit blocks of the hashes
+  DEDUP_MAX_DISTANCE = 3
+
+  def __init__(
+    self, mediamgr, ocr_url, ocr_socket=None, dbstore=None, engine='paddleocr',
+    min_photo_size=0, max_document_size=0, dedup_distance=None,
+    concurrency=0,
+  ):
+    '''dbstore: if given, results are persisted in the ocr_results table
+    engine: recorded with results; only results of the same engine are reused
+    min_photo_size: download the smallest photo size with the longer side at
+      least this many pixels; the largest is tried if no text is found
+    max_document_size: skip image documents larger than this many bytes
+    dedup_distance: reuse results of images whose perceptual hashes differ
+      by at most this many bits (up to DEDUP_MAX_DISTANCE); needs dbstore and
+      Pillow
+    concurrency: the maximum number of concurrent OCR requests; 0 means unlimited'''
+    self._ocr_cache = LRUCache(1000, ttl=3600)
+    metrics.register_cache('ocr', self._ocr_cache)
     self.ocr_url = ocr_url
     self.mediamgr = mediamgr
+    self.dbstore = dbstore
+    self.engine = engine
+    self.min_photo_size = min_photo_size
+    self.max_document_size = max_document_size
+    if concurrency:
+      self._limit = asyncio.Semaphore(concurrency)
+    else:
+      self._limit = contextlib.nullcontext()
+    if dedup_distance is not None and dbstore is not None:
+      if not 0 <= dedup_distance <= self.DEDUP_MAX_DISTANCE:
+        raise ValueError(
+          f'ocr_dedup_distance must be between 0 and {self.DEDUP_MAX_DISTANCE}')
+      try:
+        from .lib.dhash import dhash
+      except ImportError:
+        raise RuntimeError('ocr_dedup_distance needs Pillow, e.g. pip install luoxu[dedup]')
+      self._dhash = dhash
+      self.dedup_distance = dedup_distance
+    else:
+      self.dedup_distance = None
 
     if ocr_socket:
       conn = aiohttp.UnixConnector(path=ocr_socket)
@@ -27,61 +69,159 @@ class OCRService:
     self._aiosession = session
 
   async def ocr_img(self, media):
+    async def load():
+      with metrics.ocr_inprogress.track_inprogress():
+        return await self._ocr_img_persisted(media)
+    return await self._ocr_cache.get_or_load(media_key(media), load)
+
+  async def _ocr_img_persisted(self, media):
+    if self.dbstore is None:
+      return await self._ocr_img_no_cache(media)
+
+    key = media_key(media)
+
+    async with self.dbstore.get_conn() as conn:
+      result = await conn.fetchval(
+        'SELECT result FROM ocr_results WHERE media_id = $1 AND engine = $2',
+        key, self.engine,
+      )
+    if result is not None:
+      metrics.cache_requests.labels('ocr_db', 'hit').inc()
+      return result
+    metrics.cache_requests.labels('ocr_db', 'miss').inc()
+
+    # not persisted, so that the image is OCR'd if the limit is raised
+    if self._too_large(media):
+      return []
+
+    phash = None
+    ret = None
+    if self.dedup_distance is not None:
+      phash = await self._phash(media)
+      if phash is not None:
+        ret = await self._find_similar(key, phash)
+
+    if ret is None:
+      ret = await self._ocr_img_no_cache(media)
+
+    async with self.dbstore.get_conn() as conn:
+      await conn.execute('''
+        INSERT INTO ocr_results (media_id, engine, result, phash)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (media_id) DO UPDATE
+          SET engine = EXCLUDED.engine, result = EXCLUDED.result,
+              phash = EXCLUDED.phash, created_at = now()
+      ''', key, self.engine, ret, phash)
+    return ret
+
+  async def _phash(self, media):
     if isinstance(media, types.MessageMediaPhoto):
-      key = media.photo.id
+      sizes = media.photo.sizes
     else:
-      key = media.document.id
+      sizes = media.document.thumbs or []
+    sizes = [
+      s for s in sizes
+      if isinstance(s, (types.PhotoSize, types.PhotoSizeProgressive, types.PhotoCachedSize))
+    ]
+    if not sizes:
+      return None
+    thumb = min(sizes, key=lambda s: s.w * s.h)
 
-    async with self._ocr_cache_lock:
-      cached = self._ocr_cache.get(key)
-      if cached is None:
-        # coroutine cannot be awaited twice, but task can
-        fu = asyncio.create_task(self._ocr_img_no_cache(media))
-        self._ocr_cache[key] = fu
+    try:
+      async with self.mediamgr.open_media(media, thumb) as data:
+        if not isinstance(data, bytes):
+          data = data.read()
+      return self._dhash(data)
+    except Exception as e:
+      logger.warning('<%s> failed to hash image %d: %r', group_title.get(), media_key(media), e)
+      return None
 
-    if cached is None:
-      return await fu
-    else:
-      if inspect.isawaitable(cached):
-        return await cached
-      else:
-        return cached
+  async def _find_similar(self, key, phash):
+    # a hash within DEDUP_MAX_DISTANCE bits equals this one in at least one
+    # of the four 16-bit blocks, each of which is indexed (see dbsetup.sql)
+    sql = '''\
+        SELECT * FROM (
+          SELECT media_id, result,
+            length(replace((phash # $1::int8)::bit(64)::text, '0', '')) AS distance
+          FROM ocr_results
+          WHERE engine = $2 AND media_id <> $3 AND (
+            (phash & 65535) = ($1::int8 & 65535)
+            OR ((phash >> 16) & 65535) = (($1::int8 >> 16) & 65535)
+            OR ((phash >> 32) & 65535) = (($1::int8 >> 32) & 65535)
+            OR ((phash >> 48) & 65535) = (($1::int8 >> 48) & 65535)
+          )
+        ) t
+        WHERE distance <= $4
+        ORDER BY distance LIMIT 1'''
+    async with self.dbstore.get_conn() as conn:
+      row = await conn.fetchrow(sql, phash, self.engine, key, self.dedup_distance)
+    if row is None:
+      metrics.cache_requests.labels('ocr_phash', 'miss').inc()
+      return None
+
+    similar, result, distance = row
+    metrics.cache_requests.labels('ocr_phash', 'hit').inc()
+    logger.info('<%s> reusing OCR result of similar image %d for %d (distance %d)',
+                group_title.get(), similar, key, distance)
+    return result
 
   async def _ocr_img_no_cache(self, media):
     if isinstance(media, types.MessageMediaPhoto):
       key = media.photo.id
-      mime_type = 'image/jpeg'
+      thumb = pick_photo_size(media.photo, self.min_photo_size)
+      ret = await self._download_and_ocr(media, key, 'image/jpeg', thumb)
+      if not ret and thumb is not None:
+        logger.info('no text found in size %s of %d, trying the largest', thumb.type, key)
+        ret = await self._download_and_ocr(media, key, 'image/jpeg', None)
+      return ret
     else:
-      key = media.document.id
-      mime_type = media.document.mime_type
+      if self._too_large(media):
+        return []
+      return await self._download_and_ocr(
+        media, media.document.id, media.document.mime_type, None)
 
+  def _too_large(self, media):
+    if isinstance(media, types.MessageMediaPhoto) or not self.max_document_size:
+      return False
+    size = media.document.size
+    if size > self.max_document_size:
+      logger.info('<%s> Skipping OCR of large image %d (%d bytes)',
+                  group_title.get(), media.document.id, size)
+      return True
+    return False
+
+  async def _download_and_ocr(self, media, key, mime_type, thumb):
     group = group_title.get()
     while True:
       try:
-        imgdata = await self.mediamgr.get_media(media)
-        break
+        async with self.mediamgr.open_media(media, thumb) as imgdata:
+          return await self._ocr_data(key, imgdata, mime_type)
       except asyncio.exceptions.IncompleteReadError:
         logger.warning('<%s> download failed with IncompleteReadError, retrying after 10s...', group)
         await asyncio.sleep(10)
 
+  async def _ocr_data(self, key, imgdata, mime_type):
+    '''imgdata is bytes or a file object'''
+    group = group_title.get()
     formdata = aiohttp.FormData()
     formdata.add_field(
       'file', imgdata,
       filename = 'image', content_type = mime_type,
     )
     formdata.add_field('lang', 'zh-Hans')
-    logger.info('<%s> Uploading media %d to OCR service...', group, key)
-    try:
-      st = time.time()
-      res = await self._aiosession.post(self.ocr_url, data=formdata)
-      j = await res.json()
-      elaped = time.time() - st
-    except Exception as e:
-      logger.error('OCR failed with %r', e)
-      return []
+    async with self._limit:
+      logger.info('<%s> Uploading media %d to OCR service...', group, key)
+      try:
+        st = time.time()
+        with span('ocr', media_id=key):
+          res = await self._aiosession.post(self.ocr_url, data=formdata)
+          j = await res.json()
+        elaped = time.time() - st
+        metrics.ocr_seconds.observe(elaped)
+      except Exception as e:
+        logger.error('OCR failed with %r', e)
+        raise OCRFailed(key) from e
 
     logger.info('OCR %d done in %.3fs.', key, elaped)
     ret = [r['text'] for r in j['result']] if j['result'] else []
-    self._ocr_cache[key] = ret
-    self._ocr_cache.expire()
     return ret
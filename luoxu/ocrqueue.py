@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from itertools import groupby
+
+from telethon.tl import types
+
+from .indexing import format_msg, has_image
+from .scheduler import Priority
+from .ctxvars import msg_source, group_title
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class OCRQueue:
+  '''OCR images after their messages have been indexed
+
+  Jobs are stored in the ocr_jobs table in the same transaction as the
+  message itself, so they survive restarts. The worker claims due jobs,
+  fetches the messages again (file references expire), runs OCR and updates
+  the stored text. Failed jobs are retried with exponential backoff.
+  '''
+
+  LEASE = 600
+  MAX_TRIES = 10
+
+  def __init__(self, dbstore, client, ocrsvc, workers: int) -> None:
+    self.dbstore = dbstore
+    self.client = client
+    self.ocrsvc = ocrsvc
+    self.workers = workers
+    self._sem = asyncio.Semaphore(workers)
+    self._wakeup = asyncio.Event()
+    self.scheduler = None
+
+  async def add_job(self, conn, group_id: int, msgid: int, created_at) -> None:
+    sql = '''
+      INSERT INTO ocr_jobs (group_id, msgid, created_at)
+      VALUES ($1, $2, $3)
+      ON CONFLICT (group_id, msgid) DO UPDATE
+        SET tries = 0, next_try = now(), last_error = NULL
+    '''
+    await conn.execute(sql, group_id, msgid, created_at)
+    metrics.ocr_jobs.labels('added').inc()
+
+  def wakeup(self) -> None:
+    self._wakeup.set()
+
+  async def run(self, scheduler) -> None:
+    '''scheduler: the HistoryScheduler messages are fetched through, at the
+    lowest priority so that OCR never holds up indexing'''
+    self.scheduler = scheduler
+    msg_source.set('ocrjob')
+    while True:
+      jobs = await self._claim(self.workers * 4)
+      if not jobs:
+        self._wakeup.clear()
+        try:
+          await asyncio.wait_for(self._wakeup.wait(), 60)
+        except asyncio.TimeoutError:
+          pass
+        continue
+
+      tasks = []
+      for group_id, group_jobs in groupby(jobs, key=lambda j: j['group_id']):
+        tasks.append(self._process_group(group_id, list(group_jobs)))
+      await asyncio.gather(*tasks)
+
+  async def _claim(self, limit: int):
+    sql = f'''
+      UPDATE ocr_jobs SET next_try = now() + interval '{self.LEASE} seconds'
+      WHERE (group_id, msgid) IN (
+        SELECT group_id, msgid FROM ocr_jobs
+        WHERE next_try <= now()
+        ORDER BY next_try LIMIT $1
+        FOR UPDATE SKIP LOCKED
+      )
+      RETURNING group_id, msgid, created_at, tries, next_try
+    '''
+    async with self.dbstore.get_conn() as conn:
+      rows = await conn.fetch(sql, limit)
+      depth = await conn.fetchval('SELECT count(*) FROM ocr_jobs')
+    metrics.ocr_queue_depth.set(depth)
+    return sorted(rows, key=lambda j: j['group_id'])
+
+  async def _process_group(self, group_id: int, jobs) -> None:
+    try:
+      msgs = await self.scheduler.get_messages(
+        group_id, Priority.ocr, types.PeerChannel(group_id),
+        ids=[j['msgid'] for j in jobs])
+    except Exception as e:
+      logger.error('failed to fetch messages for OCR jobs in %s: %r', group_id, e)
+      for job in jobs:
+        await self._failed(job, repr(e))
+      return
+
+    await asyncio.gather(*(
+      self._process_one(job, msg) for job, msg in zip(jobs, msgs)
+    ))
+
+  async def _process_one(self, job, msg) -> None:
+    if msg is None or not has_image(msg):
+      # deleted or edited away
+      await self._done(job)
+      return
+
+    group_title.set(getattr(msg.chat, 'title', None))
+    async with self._sem:
+      try:
+        text = await format_msg(msg, self.ocrsvc, raise_ocr_error=True)
+      except Exception as e:
+        await self._failed(job, repr(e))
+        return
+
+    if text is None:
+      await self._failed(job, 'not formatted')
+      return
+
+    sql = '''
+      UPDATE messages SET text = $1
+      WHERE group_id = $2 AND msgid = $3 AND created_at = $4
+    '''
+    async with self.dbstore.get_conn() as conn:
+      await conn.execute(sql, text, job['group_id'], job['msgid'], job['created_at'])
+      await self._done(job, conn)
+    logger.info('OCR job done: <%s> [%s]', group_title.get(), msg.id)
+
+  async def _done(self, job, conn=None) -> None:
+    # next_try acts as a lease token: the job may have been re-added by an
+    # edit while we were working on it
+    sql = '''
+      DELETE FROM ocr_jobs
+      WHERE group_id = $1 AND msgid = $2 AND next_try = $3
+    '''
+    if conn is None:
+      async with self.dbstore.get_conn() as conn:
+        await conn.execute(sql, job['group_id'], job['msgid'], job['next_try'])
+    else:
+      await conn.execute(sql, job['group_id'], job['msgid'], job['next_try'])
+    metrics.ocr_jobs.labels('done').inc()
+
+  async def _failed(self, job, error: str) -> None:
+    tries = job['tries'] + 1
+    metrics.ocr_jobs.labels('failed').inc()
+    if tries >= self.MAX_TRIES:
+      logger.error('OCR job for %s/%s failed %d times, giving up: %s',
+                   job['group_id'], job['msgid'], tries, error)
+      await self._done(job)
+      return
+
+    delay = min(60 * 2 ** job['tries'], 86400)
+    logger.warning('OCR job for %s/%s failed, retry in %ds: %s',
+                   job['group_id'], job['msgid'], delay, error)
+    sql = f'''
+      UPDATE ocr_jobs
+      SET tries = $4, last_error = $5,
+          next_try = now() + interval '{delay} seconds'
+      WHERE group_id = $1 AND msgid = $2 AND next_try = $3
+    '''
+    async with self.dbstore.get_conn() as conn:
+      await conn.execute(
+        sql, job['group_id'], job['msgid'], job['next_try'], tries, error)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import datetime
+from typing import Literal, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+Granularity = Literal['year', 'month']
+
+class Partition(NamedTuple):
+  name: str
+  start: datetime.datetime
+  end: datetime.datetime
+
+def period_start(d: datetime.date, granularity: Granularity) -> datetime.date:
+  if granularity == 'year':
+    return d.replace(month=1, day=1)
+  else:
+    return d.replace(day=1)
+
+def next_period(d: datetime.date, granularity: Granularity) -> datetime.date:
+  if granularity == 'year':
+    return d.replace(year=d.year + 1)
+  elif d.month == 12:
+    return d.replace(year=d.year + 1, month=1)
+  else:
+    return d.replace(month=d.month + 1)
+
+def partition_name(d: datetime.date, granularity: Granularity) -> str:
+  if granularity == 'year':
+    return f'messages_y{d.year}'
+  else:
+    return f'messages_m{d.year}{d.month:02}'
+
+async def list_partitions(conn) -> list[Partition]:
+  '''partitions of messages with range bounds, newest first'''
+  sql = r'''
+    select c.relname, bounds[1]::timestamptz, bounds[2]::timestamptz
+    from pg_inherits i
+    join pg_class c on c.oid = i.inhrelid,
+    regexp_match(
+      pg_get_expr(c.relpartbound, c.oid),
+      'FROM \(''([^'']+)''\) TO \(''([^'']+)''\)'
+    ) as b(bounds)
+    -- the default partition and unbounded ones are not searched by range
+    where i.inhparent = 'messages'::regclass and bounds is not null
+    order by 2 desc
+  '''
+  return [Partition(*row) for row in await conn.fetch(sql)]
+
+class PartitionManager:
+  '''create partitions of the messages table ahead of time
+
+  The current period and `ahead` more are kept created. Periods already
+  covered by existing partitions (e.g. a yearly one when switching to monthly
+  partitions) are left alone. Bounds of the partitions that exist are kept in
+  `partitions`, newest first, for searching.
+  '''
+
+  def __init__(
+    self, dbstore, granularity: Granularity = 'year',
+    ahead: int = 1, interval: float = 3600,
+  ) -> None:
+    if granularity not in ('year', 'month'):
+      raise ValueError(f'bad partition granularity: {granularity!r}')
+    self.dbstore = dbstore
+    self.granularity = granularity
+    self.ahead = ahead
+    self.interval = interval
+    self.partitions: list[Partition] = []
+
+  async def run(self) -> None:
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        await self.ensure()
+      except Exception:
+        logger.exception('failed to create partitions')
+
+  async def ensure(self) -> None:
+    async with self.dbstore.get_conn() as conn:
+      partitions = await list_partitions(conn)
+      d = period_start(datetime.date.today(), self.granularity)
+      for _ in range(self.ahead + 1):
+        end = next_period(d, self.granularity)
+        await self._create(conn, partitions, d, end)
+        d = end
+      self.partitions = await list_partitions(conn)
+
+  async def _create(self, conn, partitions, start: datetime.date, end: datetime.date) -> None:
+    # partition bounds are in the database's time zone, as in dbsetup.sql
+    start_t, end_t = await conn.fetchrow(
+      'select $1::date::timestamptz, $2::date::timestamptz', start, end)
+    overlapping = [p for p in partitions if p.start < end_t and p.end > start_t]
+    if any(p.start <= start_t and p.end >= end_t for p in overlapping):
+      return
+    if overlapping:
+      logger.warning(
+        'not creating partition for [%s, %s) because it overlaps %s',
+        start, end, ', '.join(p.name for p in overlapping),
+      )
+      return
+
+    name = partition_name(start, self.granularity)
+    logger.info('creating partition %s', name)
+    await conn.execute(f'''
+      CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages
+      FOR VALUES FROM ('{start}') TO ('{end}')
+    ''')
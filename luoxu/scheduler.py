@@ -0,0 +1,147 @@
+import time
+import asyncio
+import logging
+import itertools
+from enum import IntEnum
+from collections import defaultdict
+from typing import Any
+
+from telethon.errors import FloodWaitError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+  forward = 0
+  backward = 1
+  repair = 2
+  sweep = 3
+  ocr = 4
+
+class HistoryScheduler:
+  '''send history requests for all groups under a shared budget
+
+  Requests are let through at most `rate` per second (with bursts up to
+  `burst`), highest priority first, and at most `per_group` at a time for
+  each group. A request only takes a slot of its group when it's let through,
+  and requests of groups with no free slot are passed over, so that waiting
+  low priority requests never hold up others of their group. A
+  FloodWaitError pauses all requests for the time Telegram asks for.
+  '''
+
+  def __init__(self, client, rate: float = 1.0, burst: int = 5, per_group: int = 1) -> None:
+    self.client = client
+    self.rate = rate
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last_refill = time.monotonic()
+    self._paused_until = 0.0
+    # (priority, seq, group_id, future)
+    self._waiters: list[tuple[int, int, int, asyncio.Future]] = []
+    self._seq = itertools.count()
+    self._dispatcher = None
+    self._released = asyncio.Event()
+    self._group_limits: dict[int, int] = {}
+    self._inflight: defaultdict[int, int] = defaultdict(int)
+    self.per_group = per_group
+    # group_id -> {'name', 'phase', 'first_id', 'last_id'}
+    self.progress: dict[int, dict[str, Any]] = {}
+    metrics.register_history_progress(self.progress)
+
+  def pause(self, seconds: float) -> None:
+    until = time.monotonic() + seconds
+    if until > self._paused_until:
+      logger.warning('pausing history requests for %ds', seconds)
+      self._paused_until = until
+
+  def set_group_concurrency(self, group_id: int, n: int) -> None:
+    '''allow a group more concurrent requests than the default'''
+    self._group_limits[group_id] = max(n, self.per_group)
+
+  def set_progress(self, group_id: int, **kwargs) -> None:
+    self.progress.setdefault(group_id, {}).update(kwargs)
+
+  async def get_messages(self, group_id: int, priority: Priority, entity, **kwargs):
+    '''client.get_messages(entity, **kwargs), retried until it succeeds'''
+    while True:
+      await self._acquire(group_id, priority)
+      st = time.monotonic()
+      try:
+        ret = await asyncio.wait_for(self.client.get_messages(entity, **kwargs), 60)
+        metrics.get_messages_seconds.observe(time.monotonic() - st)
+        return ret
+      except asyncio.TimeoutError:
+        metrics.get_messages_errors.labels('timeout').inc()
+        logger.error('timed out getting a message, retrying: %r, %r', entity, kwargs)
+      except FloodWaitError as e:
+        metrics.get_messages_errors.labels('floodwait').inc()
+        metrics.floodwait_seconds.inc(e.seconds)
+        self.pause(e.seconds)
+        continue
+      except Exception:
+        metrics.get_messages_errors.labels('other').inc()
+        logger.exception('error in get_messages')
+      finally:
+        self._release(group_id)
+      await asyncio.sleep(1)
+
+  async def _acquire(self, group_id: int, priority: Priority) -> None:
+    '''wait for a rate token and a slot of the group'''
+    fu = asyncio.get_running_loop().create_future()
+    self._waiters.append((priority, next(self._seq), group_id, fu))
+    if self._dispatcher is None or self._dispatcher.done():
+      self._dispatcher = asyncio.create_task(self._dispatch())
+    else:
+      self._released.set()
+    try:
+      await fu
+    except asyncio.CancelledError:
+      if fu.done() and not fu.cancelled():
+        # let through but cancelled before running
+        self._release(group_id)
+      raise
+
+  def _release(self, group_id: int) -> None:
+    self._inflight[group_id] -= 1
+    self._released.set()
+
+  def _next_waiter(self):
+    '''the waiter with the highest priority whose group has a free slot'''
+    self._waiters = [w for w in self._waiters if not w[3].cancelled()]
+    eligible = [
+      w for w in self._waiters
+      if self._inflight[w[2]] < self._group_limits.get(w[2], self.per_group)
+    ]
+    return min(eligible, default=None)
+
+  def _refill(self) -> None:
+    now = time.monotonic()
+    self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+    self._last_refill = now
+
+  async def _dispatch(self) -> None:
+    while self._waiters:
+      if (wait := self._paused_until - time.monotonic()) > 0:
+        await asyncio.sleep(wait)
+        continue
+
+      if self._next_waiter() is None:
+        # all waiting groups are busy
+        self._released.clear()
+        await self._released.wait()
+        continue
+
+      self._refill()
+      if self._tokens < 1:
+        await asyncio.sleep((1 - self._tokens) / self.rate)
+        continue
+
+      # waiters may have changed while sleeping
+      w = self._next_waiter()
+      if w is None:
+        continue
+      self._waiters.remove(w)
+      self._tokens -= 1
+      self._inflight[w[2]] += 1
+      w[3].set_result(None)
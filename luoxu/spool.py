@@ -0,0 +1,168 @@
+import os
+import time
+import json
+import zlib
+import struct
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# payload length, CRC32 of payload, time spooled
+HEADER = struct.Struct('>IId')
+
+class Spool:
+  '''an append-only local journal of records (JSON objects)
+
+  Records are kept in segment files named by sequence number, each record as
+  a header and its payload. Appends made while a write is in progress are
+  written and fsync'ed together by a single flusher, and return once their
+  records are on disk. A new segment is started on each run, so a record torn
+  by a crash can only be at the end of an old segment, where reading stops.
+  '''
+
+  def __init__(self, directory: str, segment_size: int = 16 * 1024 * 1024) -> None:
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.segment_size = segment_size
+    segs = self._segments()
+    self._seq = segs[-1] + 1 if segs else 0
+    self._file = None
+    self._pending: list[tuple[bytes, asyncio.Future]] = []
+    self._flusher: Optional[asyncio.Task] = None
+    self._has_data = asyncio.Event()
+    if segs:
+      self._has_data.set()
+    # time the oldest record not yet replayed was spooled, when known
+    self.oldest: Optional[float] = None
+    metrics.register_spool(self)
+
+  @property
+  def active(self) -> bool:
+    '''whether there are records not yet replayed'''
+    return self._has_data.is_set()
+
+  async def wait(self) -> None:
+    await self._has_data.wait()
+
+  def size(self) -> int:
+    total = 0
+    for seq in self._segments():
+      try:
+        total += os.stat(self._path(seq)).st_size
+      except FileNotFoundError:
+        pass
+    return total
+
+  def _path(self, seq: int) -> str:
+    return os.path.join(self.directory, f'{seq:012d}.seg')
+
+  def _segments(self) -> list[int]:
+    return sorted(
+      int(name.removesuffix('.seg'))
+      for name in os.listdir(self.directory) if name.endswith('.seg')
+    )
+
+  async def append(self, record: dict) -> None:
+    data = json.dumps(record, ensure_ascii=False).encode()
+    header = HEADER.pack(len(data), zlib.crc32(data), time.time())
+    fu = asyncio.get_running_loop().create_future()
+    self._pending.append((header + data, fu))
+    self._has_data.set()
+    if self._flusher is None or self._flusher.done():
+      self._flusher = asyncio.create_task(self._flush())
+    await fu
+
+  async def _flush(self) -> None:
+    loop = asyncio.get_running_loop()
+    while self._pending:
+      batch, self._pending = self._pending, []
+      try:
+        await loop.run_in_executor(None, self._write, b''.join(d for d, _ in batch))
+      except Exception as e:
+        for _, fu in batch:
+          if not fu.done():
+            fu.set_exception(e)
+        continue
+      if self.oldest is None:
+        self.oldest = HEADER.unpack_from(batch[0][0])[2]
+      metrics.spool_records.labels('spooled').inc(len(batch))
+      for _, fu in batch:
+        if not fu.done():
+          fu.set_result(None)
+
+  def _write(self, data: bytes) -> None:
+    if self._file is None or self._file.tell() >= self.segment_size:
+      self._close()
+      self._file = open(self._path(self._seq), 'ab')
+      self._seq += 1
+      dirfd = os.open(self.directory, os.O_RDONLY)
+      try:
+        os.fsync(dirfd)
+      finally:
+        os.close(dirfd)
+    self._file.write(data)
+    self._file.flush()
+    os.fsync(self._file.fileno())
+
+  def _close(self) -> None:
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  async def _seal(self) -> None:
+    '''finish writing the current segment so that it can be replayed'''
+    while self._flusher is not None and not self._flusher.done():
+      await asyncio.shield(self._flusher)
+    self._close()
+
+  def _read(self, seq: int) -> list[tuple[float, dict]]:
+    path = self._path(seq)
+    with open(path, 'rb') as f:
+      data = f.read()
+    records = []
+    pos = 0
+    while pos < len(data):
+      if pos + HEADER.size > len(data):
+        logger.warning('%s: truncated record at %d, ignoring the rest', path, pos)
+        break
+      size, crc, t = HEADER.unpack_from(data, pos)
+      payload = data[pos + HEADER.size:pos + HEADER.size + size]
+      if len(payload) < size or zlib.crc32(payload) != crc:
+        logger.warning('%s: broken record at %d, ignoring the rest', path, pos)
+        break
+      records.append((t, json.loads(payload)))
+      pos += HEADER.size + size
+    return records
+
+  async def replay(
+    self, apply: Callable[[list[dict]], Awaitable[None]], batch_size: int = 1000,
+  ) -> None:
+    '''pass all records to apply in order, batch_size records at a time
+
+    Each segment is deleted once all its records are applied, so if apply
+    raises, records of the current segment will be applied again next time.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+      await self._seal()
+      segs = self._segments()
+      if not segs:
+        # nothing can have been appended since _seal returned
+        self._has_data.clear()
+        self.oldest = None
+        return
+
+      for seq in segs:
+        records = await loop.run_in_executor(None, self._read, seq)
+        if records:
+          self.oldest = records[0][0]
+          logger.info('replaying %d spooled records from segment %d', len(records), seq)
+        for i in range(0, len(records), batch_size):
+          chunk = records[i:i + batch_size]
+          await apply([r for _, r in chunk])
+          metrics.spool_records.labels('replayed').inc(len(chunk))
+        os.unlink(self._path(seq))
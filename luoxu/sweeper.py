@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import logging
+import datetime
+
+from telethon.tl.patched import MessageService
+
+from .ctxvars import msg_source
+from .indexing import format_msgs
+from .scheduler import Priority
+from .util import UpdateLoaded
+
+logger = logging.getLogger(__name__)
+
+def text_digest(text: str) -> str:
+  '''same as md5() in PostgreSQL'''
+  return hashlib.md5(text.encode()).hexdigest()
+
+class EditSweeper:
+  '''re-fetch recent messages and update those changed while we weren't looking
+
+  Edits made while we're offline are not delivered as updates. Every
+  `interval` seconds, messages of the last `days` days are fetched again by
+  id, 100 at a time, and only those newer than or different from the stored
+  rows are written. Each group gets at most `budget` requests per sweep, at
+  the lowest priority of the history scheduler.
+  '''
+
+  BATCH = 100
+
+  def __init__(
+    self, dbstore, scheduler, groups,
+    days: float = 7, interval: float = 3600, budget: int = 100,
+  ) -> None:
+    '''groups: a list of (entity, use_ocr)'''
+    self.dbstore = dbstore
+    self.scheduler = scheduler
+    self.groups = groups
+    self.window = datetime.timedelta(days=days)
+    self.interval = interval
+    self.budget = budget
+
+  async def run(self) -> None:
+    msg_source.set('sweep')
+    while True:
+      for entity, use_ocr in self.groups:
+        try:
+          await self.sweep_group(entity, use_ocr)
+        except Exception:
+          logger.exception('failed to sweep group %s', entity.id)
+      await asyncio.sleep(self.interval)
+
+  async def sweep_group(self, entity, use_ocr) -> None:
+    group_id = entity.id
+    since = datetime.datetime.now(datetime.timezone.utc) - self.window
+    first, last = await self.dbstore.get_msgid_window(group_id, since)
+    if first is None:
+      return
+
+    # newest first so that the budget goes to the most likely edited
+    checked = updated = 0
+    end = last
+    for _ in range(self.budget):
+      if end < first:
+        break
+      start = max(first, end - self.BATCH + 1)
+      msgs = await self.scheduler.get_messages(
+        group_id, Priority.sweep, entity, ids=list(range(start, end + 1)))
+      msgs = [m for m in msgs if m is not None]
+      changed, texts, skipped = await self._changed(group_id, msgs, start, end, since)
+      if changed:
+        await self.dbstore.insert_messages(
+          changed, UpdateLoaded.update_none, use_ocr = use_ocr,
+          covered = (start, end), skipped = skipped, formatted = texts,
+        )
+      checked += len(msgs)
+      updated += len(changed)
+      end = start - 1
+
+    logger.info('swept group %s: %d messages checked, %d updated',
+                group_id, checked, updated)
+
+  async def _changed(self, group_id, msgs, start, end, since):
+    '''return changed messages, their texts formatted without OCR by id,
+    and ids of messages that couldn't be checked'''
+    if not msgs:
+      return [], {}, []
+    stored = await self.dbstore.get_msg_digests(group_id, start, end, since)
+    texts = await format_msgs(msgs)
+
+    changed = []
+    changed_texts = {}
+    skipped = []
+    for msg, text in zip(msgs, texts):
+      if text is None:
+        if not isinstance(msg, MessageService):
+          # failed; leave it for the gap repairer
+          skipped.append(msg.id)
+        continue
+      row = stored.get(msg.id)
+      if (
+        row is None
+        or (msg.edit_date and (row['updated_at'] is None or msg.edit_date > row['updated_at']))
+        # e.g. web previews are filled in without edit_date changing
+        or text_digest(text) != row['digest']
+      ):
+        changed.append(msg)
+        changed_texts[msg.id] = text
+    return changed, changed_texts, skipped
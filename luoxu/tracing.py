@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextlib
+from typing import Optional, Any
+
+from .ctxvars import msg_source, group_title, current_span
+
+logger = logging.getLogger(__name__)
+
+_output: Optional[queue.Queue] = None
+_dropped = 0
+
+class Span:
+  def __init__(self, name: str, parent: Optional['Span'], attrs: dict[str, Any]) -> None:
+    self.name = name
+    self.span_id = os.urandom(8).hex()
+    if parent:
+      self.trace_id = parent.trace_id
+      self.parent_id = parent.span_id
+    else:
+      self.trace_id = os.urandom(16).hex()
+      self.parent_id = None
+    self.attrs = attrs
+    self.start = time.time()
+    self._st = time.monotonic()
+
+  def set(self, **attrs) -> None:
+    self.attrs.update(attrs)
+
+  def to_dict(self, duration: float) -> dict[str, Any]:
+    return {
+      'trace_id': self.trace_id,
+      'span_id': self.span_id,
+      'parent_id': self.parent_id,
+      'name': self.name,
+      'start': self.start,
+      'duration': round(duration, 6),
+      'source': msg_source.get(),
+      'group': group_title.get(),
+      **self.attrs,
+    }
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+  '''time the enclosed block as a child of the current span
+
+  Spans are only recorded after `setup` has been called.'''
+  if _output is None:
+    yield None
+    return
+
+  s = Span(name, current_span.get(), attrs)
+  token = current_span.set(s)
+  try:
+    yield s
+  except BaseException as e:
+    s.attrs['error'] = repr(e)
+    raise
+  finally:
+    current_span.reset(token)
+    _emit(s.to_dict(time.monotonic() - s._st))
+
+def _emit(record: dict[str, Any]) -> None:
+  global _dropped
+  try:
+    _output.put_nowait(record)
+  except queue.Full:
+    _dropped += 1
+
+class _Writer(threading.Thread):
+  '''serialize and write spans off the event loop
+
+  Lines are buffered and flushed whenever the queue runs empty.'''
+
+  def __init__(self, q: queue.Queue, file: Optional[str]) -> None:
+    super().__init__(name='tracing', daemon=True)
+    self.q = q
+    self.file = open(file, 'a', encoding='utf-8') if file else None
+
+  def run(self) -> None:
+    global _dropped
+    while True:
+      record = self.q.get()
+      while record is not None:
+        self._write(record)
+        try:
+          record = self.q.get_nowait()
+        except queue.Empty:
+          break
+      if _dropped:
+        logger.warning('dropped %d spans because the writer fell behind', _dropped)
+        _dropped = 0
+      if self.file:
+        try:
+          self.file.flush()
+        except OSError as e:
+          logger.error('failed to write spans: %r', e)
+      if record is None:
+        return
+
+  def _write(self, record: dict[str, Any]) -> None:
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    if self.file is None:
+      logger.info('%s', line)
+      return
+    try:
+      self.file.write(line + '\n')
+    except OSError as e:
+      logger.error('failed to write span: %r', e)
+
+def _stop(q: queue.Queue, writer: _Writer) -> None:
+  q.put(None)
+  writer.join(timeout=5)
+
+def setup(config: dict[str, Any]) -> None:
+  '''enable tracing according to the [tracing] config section
+
+  Spans are written as JSON lines to `file` if given, or logged otherwise,
+  from a background thread. At most `queue_size` spans wait to be written;
+  more are dropped.'''
+  global _output
+  if not config.get('enabled', True):
+    return
+  q = queue.Queue(config.get('queue_size', 10000))
+  writer = _Writer(q, config.get('file'))
+  writer.start()
+  atexit.register(_stop, q, writer)
+  _output = q
@@ -51,6 +51,8 @@ def create_client(tg_config):
   for k in ['device_model', 'system_version', 'app_version']:
     if v := tg_config.get(k):
       kwargs[k] = v
+  if (t := tg_config.get('flood_sleep_threshold')) is not None:
+    kwargs['flood_sleep_threshold'] = t
 
   client = TelegramClient(
     tg_config['session_db'],
@@ -10,6 +10,7 @@ from telethon.tl.types import User, ChatPhotoEmpty
 from telethon.errors.rpcerrorlist import ChannelPrivateError
 
 from . import util
+from . import metrics
 from .types import SearchQuery, GroupNotFound
 
 logger = logging.getLogger(__name__)
@@ -106,6 +107,23 @@ class NamesHandler(BaseHandler):
       'Cache-Control': 's-maxage=0, max-age=86400',
     })
 
+async def metrics_handler(request):
+  return web.Response(
+    text = metrics.render(),
+    content_type = 'text/plain',
+    charset = 'utf-8',
+    headers = {
+      'Cache-Control': 'no-store',
+    },
+  )
+
+@web.middleware
+async def metrics_middleware(request, handler):
+  resource = request.match_info.route.resource
+  route = resource.canonical if resource else 'unknown'
+  with metrics.http_request_seconds.labels(route).time():
+    return await handler(request)
+
 class AvatarHandler:
   def __init__(self, client, cache_dir, default_avatar: str, ghost_avatar: str) -> None:
     self.client = client
@@ -174,8 +192,9 @@ def setup_app(
   *,
   prefix = '',
   origins = (),
+  enable_metrics = False,
 ):
-  app = web.Application()
+  app = web.Application(middlewares=[metrics_middleware])
   app['origins'] = origins
   app.router.add_get(f'{prefix}/search', SearchHandler(dbconn).get)
   app.router.add_get(f'{prefix}/groups', GroupsHandler(dbconn).get)
@@ -186,10 +205,12 @@ def setup_app(
     app.router.add_get(fr'{prefix}/avatar/{{uid:\d+}}.jpg', ah.get)
     app.router.add_get(fr'{prefix}/avatar/{{name:\w+}}.jpg', ah.get)
 
+  if enable_metrics:
+    app.router.add_get(f'{prefix}/metrics', metrics_handler)
+
   return app
 
 async def run_web(config, port):
-  import asyncio
   from .db import PostgreStore
   db = PostgreStore(config['database'])
   await db.setup()
@@ -204,6 +225,7 @@ async def run_web(config, port):
     os.path.abspath(web_config['ghost_avatar']),
     prefix = web_config['prefix'],
     origins = web_config['origins'],
+    enable_metrics = web_config.get('metrics', False),
   )
   runner = web.AppRunner(app)
   await runner.setup()
@@ -212,8 +234,8 @@ async def run_web(config, port):
     web_config['listen_host'], port,
   )
   await site.start()
-  while True:
-    await asyncio.sleep(3600)
+  # keep the partition list searched up to date with the indexer's
+  await db.partitions.run()
 
 if __name__ == '__main__':
   from .lib.nicelogger import enable_pretty_logging
@@ -1,36 +1,178 @@
+import asyncio
 import logging
+from functools import partial
 
 from aiohttp import web
+from telethon import utils, types
+from telethon.errors import RPCError
+
+from luoxu.lib.lrucache import LRUCache
+from luoxu import metrics
 
 logger = logging.getLogger('luoxu_plugins.adminapi')
 
 class IsAdminHandler():
-  def __init__(self, client):
+  '''tell whether the sender of a message may ban users
+
+  Senders of messages are taken from the luoxu database when indexed, and
+  both senders and permissions are cached so that repeated reports cost no
+  Telegram requests. Senders are kept as marked ids so that users and
+  channels (sending as a channel) are not confused.
+  '''
+
+  def __init__(self, client, dbstore, perm_ttl=300, sender_ttl=3600):
     self.client = client
+    self.dbstore = dbstore
+    # (channel_id, msgid) -> marked sender id
+    self.senders = LRUCache(65536, ttl=sender_ttl)
+    # (channel_id, sender id) -> permissions
+    self.perms = LRUCache(4096, ttl=perm_ttl)
+    metrics.register_cache('adminapi_senders', self.senders)
+    metrics.register_cache('adminapi_perms', self.perms)
 
   async def post(self, request):
     params = await request.post()
-    group_id = params['group']
-    msg_id = int(params['msgid'])
-    if not group_id.startswith('@'):
-      group_id = int(group_id)
-
-    client = self.client
-    msgs = await client.get_messages(group_id, ids=[msg_id])
-    msg = msgs[0]
-    perms = await client.get_permissions(msg.chat, msg.sender)
-    ret = {
+    try:
+      r = await self.check(params['group'], int(params['msgid']))
+    except LookupError as e:
+      return web.json_response({'error': str(e)}, status=404)
+    return web.json_response(r)
+
+  async def post_batch(self, request):
+    '''body: {"messages": [{"group": ..., "msgid": ...}, ...]}'''
+    items = (await request.json())['messages']
+    by_group = {}
+    for item in items:
+      by_group.setdefault(str(item['group']), []).append(int(item['msgid']))
+    # one Telegram request per group at most for unknown senders
+    errors = {}
+    for group, failed in zip(by_group, await asyncio.gather(*(
+      self.prefetch_senders(group, msgids) for group, msgids in by_group.items()
+    ))):
+      errors.update(((group, msgid), e) for msgid, e in failed.items())
+
+    async def check_one(item):
+      group, msgid = str(item['group']), int(item['msgid'])
+      if e := errors.get((group, msgid)):
+        r = {'error': e}
+      else:
+        try:
+          r = await self.check(group, msgid)
+        except LookupError as e:
+          r = {'error': str(e)}
+        except RPCError as e:
+          r = {'error': f'telegram error: {e}'}
+      return {'group': item['group'], 'msgid': item['msgid'], **r}
+
+    results = await asyncio.gather(*(check_one(item) for item in items))
+    return web.json_response({'results': results})
+
+  async def resolve_group(self, group):
+    '''return the marked peer id for Telegram and the bare id luoxu uses'''
+    if group.startswith('@'):
+      entity = group
+    else:
+      entity = int(group)
+    try:
+      peer_id = await self.client.get_peer_id(entity)
+    except ValueError:
+      raise LookupError('group not found')
+    return peer_id, utils.resolve_id(peer_id)[0]
+
+  async def check(self, group, msgid):
+    peer_id, channel_id = await self.resolve_group(group)
+    key = channel_id, msgid
+    sender_id = await self.senders.get_or_load(
+      key, partial(self.load_sender, peer_id, channel_id, msgid))
+    if sender_id is None:
+      self.senders.pop(key)
+      raise LookupError('message not found')
+
+    try:
+      perms = await self.perms.get_or_load(
+        (channel_id, sender_id), partial(self.client.get_permissions, peer_id, sender_id))
+    except ValueError:
+      # the indexed sender id may be a channel (sending as a channel); ask
+      # Telegram for the real peer
+      msgs = await self.client.get_messages(peer_id, ids=[msgid])
+      if not msgs or msgs[0] is None:
+        raise LookupError('message not found')
+      sender_id = msgs[0].sender_id
+      self.senders[key] = sender_id
+      perms = await self.perms.get_or_load(
+        (channel_id, sender_id), partial(self.client.get_permissions, peer_id, sender_id))
+
+    return {
       'ban_users': perms.ban_users,
     }
-    return web.json_response(ret)
+
+  def marked_sender(self, sender_id):
+    '''the marked id of a sender stored bare in the database, or None if
+    the session doesn't know it as exactly one of a user and a channel'''
+    if not sender_id:
+      return None
+    session = self.client.session
+    found = [
+      marked for marked in (
+        utils.get_peer_id(types.PeerUser(sender_id)),
+        utils.get_peer_id(types.PeerChannel(sender_id)),
+      ) if session.get_entity_rows_by_id(marked, exact=True)
+    ]
+    return found[0] if len(found) == 1 else None
+
+  async def load_sender(self, peer_id, channel_id, msgid):
+    senders = await self.dbstore.get_senders(channel_id, [msgid])
+    if sender_id := self.marked_sender(senders.get(msgid)):
+      return sender_id
+    msgs = await self.client.get_messages(peer_id, ids=[msgid])
+    if not msgs or msgs[0] is None:
+      return None
+    return msgs[0].sender_id
+
+  async def prefetch_senders(self, group, msgids):
+    '''cache senders of messages; return {msgid: error message} for those
+    that can't be fetched'''
+    try:
+      peer_id, channel_id = await self.resolve_group(group)
+    except LookupError:
+      # reported per message later
+      return {}
+    missing = [m for m in msgids if (channel_id, m) not in self.senders]
+    if not missing:
+      return {}
+
+    senders = {
+      msgid: self.marked_sender(sender_id)
+      for msgid, sender_id in (await self.dbstore.get_senders(channel_id, missing)).items()
+    }
+    missing = [m for m in missing if not senders.get(m)]
+    if missing:
+      try:
+        msgs = await self.client.get_messages(peer_id, ids=missing)
+      except RPCError as e:
+        logger.error('failed to fetch senders in %s: %r', group, e)
+        return dict.fromkeys(missing, f'telegram error: {e}')
+      for msg in msgs:
+        if msg is not None:
+          senders[msg.id] = msg.sender_id
+    for msgid, sender_id in senders.items():
+      if sender_id:
+        self.senders[(channel_id, msgid)] = sender_id
+    return {}
 
 async def register(indexer, client):
-  port = indexer.config['plugin']['adminapi']['port']
+  config = indexer.config['plugin']['adminapi']
+  port = config['port']
 
-  handler = IsAdminHandler(client)
+  handler = IsAdminHandler(
+    client, indexer.dbstore,
+    perm_ttl = config.get('perm_ttl', 300),
+    sender_ttl = config.get('sender_ttl', 3600),
+  )
 
   app = web.Application()
   app.router.add_post('/api/isadmin', handler.post)
+  app.router.add_post('/api/isadmin/batch', handler.post_batch)
 
   runner = web.AppRunner(app)
   await runner.setup()
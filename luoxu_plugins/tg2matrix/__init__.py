@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from telethon import events
@@ -10,10 +12,27 @@ from . import utils
 logger = logging.getLogger('luoxu_plugins.tg2matrix')
 
 class DB:
+  '''message mappings, with sqlite accessed from a dedicated thread
+
+  New mappings are kept in memory and written in batches.
+  '''
+
+  FLUSH_DELAY = 1
+  FLUSH_SIZE = 100
+
   def __init__(self) -> None:
     self.dbfile = os.path.join(os.path.dirname(__file__), 'tg2matrix.db')
-    self.db = sqlite3.connect(self.dbfile, autocommit=False)
+    self.db = sqlite3.connect(self.dbfile, autocommit=False, check_same_thread=False)
     self._may_init()
+    self._executor = ThreadPoolExecutor(1, thread_name_prefix='tg2matrix-db')
+    # (channel_id, msg_id) -> (event_id, replied_to)
+    self._pending: dict[tuple[int, int], tuple[str, Optional[str]]] = {}
+    self._flush_handle = None
+    self._tasks = set()
+
+  async def _run(self, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._executor, func, *args)
 
   def _may_init(self) -> None:
     with self.db:
@@ -44,7 +63,14 @@ class DB:
       finally:
         self.db.autocommit = False
 
-  def get_matrix_event_id(
+  async def get_matrix_event_id(
+    self, channel_id: int, msg_id: int,
+  ) -> Optional[str]:
+    if r := self._pending.get((channel_id, msg_id)):
+      return r[0]
+    return await self._run(self._get_matrix_event_id, channel_id, msg_id)
+
+  def _get_matrix_event_id(
     self, channel_id: int, msg_id: int,
   ) -> Optional[str]:
     with self.db:
@@ -62,42 +88,108 @@ class DB:
     self, channel_id: int, msg_id: int,
     event_id: str, replied_to: str | None,
   ) -> None:
+    '''save a mapping later; the first one for a message is kept'''
+    self._pending.setdefault((channel_id, msg_id), (event_id, replied_to))
+    if len(self._pending) >= self.FLUSH_SIZE:
+      self._schedule_flush(0)
+    else:
+      self._schedule_flush(self.FLUSH_DELAY)
+
+  def _schedule_flush(self, delay: float) -> None:
+    if self._flush_handle is not None:
+      if delay > 0:
+        return
+      self._flush_handle.cancel()
+    self._flush_handle = asyncio.get_running_loop().call_later(
+      delay, self._start_flush)
+
+  def _start_flush(self) -> None:
+    self._flush_handle = None
+    rows = [(c, m, e, r) for (c, m), (e, r) in self._pending.items()]
+    task = asyncio.create_task(self._flush(rows))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  async def _flush(self, rows) -> None:
+    try:
+      await self._run(self._save_many, rows)
+    except Exception:
+      logger.exception('failed to save %d message mappings, will retry', len(rows))
+      self._schedule_flush(self.FLUSH_DELAY * 10)
+      return
+    for channel_id, msg_id, *_ in rows:
+      self._pending.pop((channel_id, msg_id), None)
+
+  def _save_many(self, rows) -> None:
     with self.db:
-      try:
-        self.db.execute('''
-          INSERT INTO msg_mapping
-            (channel_id, msg_id, event_id, replied_to)
-          VALUES (?, ?, ?, ?)''',
-          (channel_id, msg_id, event_id, replied_to))
-      except sqlite3.IntegrityError:
-        pass
+      self.db.executemany('''
+        INSERT OR IGNORE INTO msg_mapping
+          (channel_id, msg_id, event_id, replied_to)
+        VALUES (?, ?, ?, ?)''', rows)
 
 class TgChannelWatcher:
+  '''forward messages of channels to Matrix
+
+  Messages of a channel are sent one by one in order, while channels proceed
+  independently. A message whose request is lost with its connection is
+  sent again, up to SEND_ATTEMPTS times; it may then show up twice if the
+  other side had processed it.
+  '''
+
+  SEND_ATTEMPTS = 5
+
   def __init__(self, client, socket_path, channels):
-    self.socket_path = socket_path
+    self.conn = utils.MatrixConnection(socket_path)
     self.channels = channels
     self.channel_ids = {}
     self.client = client
     self.db = DB()
+    self._queues: dict[int, asyncio.Queue] = {}
+    self._workers = set()
 
-  async def on_event(self, event):
-    if not self.channel_ids and self.channels:
-      for g, m in self.channels.items():
-        if isinstance(g, int):
-          self.channel_ids[g] = m
-        else:
-          e = await self.client.get_entity(g)
-          self.channel_ids[e.id] = m
+  async def resolve_channels(self):
+    for g, m in self.channels.items():
+      if isinstance(g, int):
+        self.channel_ids[g] = m
+      else:
+        e = await self.client.get_entity(g)
+        self.channel_ids[e.id] = m
 
+  async def on_event(self, event):
     msg = event.message
-    if getattr(msg.peer_id, 'channel_id', None) in self.channel_ids:
-      await self.process_message(msg)
+    channel_id = getattr(msg.peer_id, 'channel_id', None)
+    if channel_id not in self.channel_ids:
+      return
+    q = self._queues.get(channel_id)
+    if q is None:
+      q = self._queues[channel_id] = asyncio.Queue()
+      task = asyncio.create_task(self._channel_worker(q))
+      self._workers.add(task)
+      task.add_done_callback(self._workers.discard)
+    q.put_nowait(msg)
+
+  async def _channel_worker(self, q):
+    while True:
+      msg = await q.get()
+      for i in range(self.SEND_ATTEMPTS):
+        try:
+          await self.process_message(msg)
+        except (ConnectionError, OSError) as e:
+          if i == self.SEND_ATTEMPTS - 1:
+            logger.error('giving up sending message %s to Matrix: %r', msg.id, e)
+          else:
+            logger.warning('failed to send message %s to Matrix, retrying: %r', msg.id, e)
+            await asyncio.sleep(2 ** i)
+            continue
+        except Exception:
+          logger.exception('failed to send message %s to Matrix', msg.id)
+        break
 
   async def process_message(self, msg):
     channel_id = msg.peer_id.channel_id
-    event_id = self.db.get_matrix_event_id(channel_id, msg.id)
+    event_id = await self.db.get_matrix_event_id(channel_id, msg.id)
     if msg.reply_to and (replied_to := msg.reply_to.reply_to_msg_id):
-      reply_to = self.db.get_matrix_event_id(channel_id, replied_to)
+      reply_to = await self.db.get_matrix_event_id(channel_id, replied_to)
     else:
       reply_to = None
 
@@ -115,13 +207,16 @@ class TgChannelWatcher:
     if reply_to:
       mmsg['reply_to'] = reply_to
 
-    event_id = utils.send_message(self.socket_path, mmsg)
-    self.db.save_matrix_event_id(channel_id, msg.id, event_id, reply_to)
+    new_event_id = await self.conn.send_message(mmsg)
+    if not event_id:
+      self.db.save_matrix_event_id(channel_id, msg.id, new_event_id, reply_to)
 
-def register(indexer, client):
+async def register(indexer, client):
   config = indexer.config['plugin']['tg2matrix']
   channels = config['channels']
   socket_path = config['socket_path']
   w = TgChannelWatcher(client, socket_path, channels)
-  client.add_event_handler(w.on_event, events.NewMessage())
-  client.add_event_handler(w.on_event, events.MessageEdited())
+  await w.resolve_channels()
+  chats = list(w.channel_ids)
+  client.add_event_handler(w.on_event, events.NewMessage(chats=chats))
+  client.add_event_handler(w.on_event, events.MessageEdited(chats=chats))
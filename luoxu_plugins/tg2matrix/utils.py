@@ -1,30 +1,54 @@
-import socket
+import asyncio
 import json
 import html
 import struct
+import logging
 from typing import Literal, Any
 
 from telethon.helpers import add_surrogate, del_surrogate
 
-def recv_n(sock, n):
-  data = b''
-  while (remaining := n - len(data)) > 0:
-    data += sock.recv(remaining)
-  return data
-
-def send_message(socket_path, msg):
-  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-  s.connect(socket_path)
-  m = json.dumps(msg, ensure_ascii=False).encode()
-  size = struct.pack('>I', len(m))
-  s.sendall(size)
-  s.sendall(m)
-
-  size = recv_n(s, 4)
-  n = struct.unpack('>I', size)[0]
-  ret = recv_n(s, n)
-  s.close()
-  return json.loads(ret)['id']
+logger = logging.getLogger(__name__)
+
+class MatrixConnection:
+  '''requests to the Matrix side
+
+  Messages are JSON prefixed with their length as a 32-bit big-endian
+  integer. The other side answers one request per connection, so each
+  request opens its own; requests of different channels still proceed
+  concurrently.
+  '''
+
+  def __init__(self, socket_path: str) -> None:
+    self.socket_path = socket_path
+
+  async def _connect(self):
+    for i in range(5):
+      try:
+        return await asyncio.open_unix_connection(self.socket_path)
+      except OSError as e:
+        if i == 4:
+          raise
+        logger.warning('failed to connect to %s, retrying: %r', self.socket_path, e)
+        await asyncio.sleep(2 ** i)
+
+  async def request(self, msg: dict[str, Any]) -> dict[str, Any]:
+    # only connecting is retried here; a request that has been sent may have
+    # been processed, so whether to send it again is up to the caller
+    reader, writer = await self._connect()
+    try:
+      m = json.dumps(msg, ensure_ascii=False).encode()
+      writer.write(struct.pack('>I', len(m)) + m)
+      await writer.drain()
+      size = struct.unpack('>I', await reader.readexactly(4))[0]
+      return json.loads(await reader.readexactly(size))
+    except asyncio.IncompleteReadError as e:
+      raise ConnectionError(
+        f'connection to {self.socket_path} closed without a response') from e
+    finally:
+      writer.close()
+
+  async def send_message(self, msg: dict[str, Any]) -> str:
+    return (await self.request(msg))['id']
 
 def tg_message_to_html(msg):
   ret = []
@@ -5,37 +5,75 @@ import datetime
 import math
 import subprocess
 import logging
+import json
+import struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional
 
 from telethon import utils
 from wordcloud import WordCloud
 
+from luoxu.lib.lrucache import LRUCache
+from luoxu import metrics
+
 logger = logging.getLogger('luoxu_plugins.wordcloud')
 
 CUTWORDS_EXE = 'luoxu-cutwords'
 FONT = '/usr/share/fonts/adobe-source-han-sans/SourceHanSansCN-Normal.otf'
 TIMEZONE = datetime.timezone(datetime.timedelta(hours=8))
 DBSTRING: str
-
-def gen_image(words, stream):
+# a running `luoxu-cutwords --serve` instance
+CUTWORDS_SOCKET: Optional[str] = None
+# WordCloud draws at most this many words (its max_words)
+TOP_WORDS = 200
+# requests for the same group and user whose start times fall in the same
+# this many seconds share one result
+TIME_BUCKET = 300
+RENDER_WORKERS = 2
+
+# (chat_id, user_id, start) -> (total_messages, words, generated_at)
+_counts = LRUCache(64, ttl=600)
+# (chat_id, user_id, start) -> PNG data
+_images = LRUCache(ttl=600, maxsize=None, weigher=len, maxweight=32 * 1024 * 1024)
+_render_pool: Optional[ProcessPoolExecutor] = None
+
+def gen_image(words):
   image = WordCloud(
     font_path = FONT, width = 800, height = 400,
   ).generate_from_frequencies(words).to_image()
+  stream = io.BytesIO()
   image.save(stream, 'PNG')
+  return stream.getvalue()
+
+async def render(words):
+  global _render_pool
+  if _render_pool is None:
+    # rendering is CPU-bound; keep it off the event loop's thread pool and
+    # limit how many run at once
+    _render_pool = ProcessPoolExecutor(
+      RENDER_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_render_pool, gen_image, words)
+
+async def count_words(chat_id, start, user_id):
+  st = time.time()
+  if CUTWORDS_SOCKET:
+    total_messages, words = await cutwords_via_socket(chat_id, start, user_id)
+  else:
+    total_messages, words = await cutwords_via_exe(chat_id, start, user_id)
+  logger.info('分析完成，用时 %.3fs', time.time() - st)
+  return total_messages, words, datetime.datetime.now().astimezone(TIMEZONE)
 
-async def generate_wordcloud(chat_id, chat_title, target_user, endtime, reply):
-  logger.info(
-    '生成词云，群组 %s，用户 %s, 结束时间 %s',
-    chat_title,
-    utils.get_display_name(target_user),
-    endtime.strftime('%Y-%m-%d %H:%M:%S%z'),
-  )
-  st = datetime.datetime.now().astimezone(TIMEZONE)
+async def cutwords_via_exe(chat_id, start, user_id):
   cmd = [
     CUTWORDS_EXE,
     DBSTRING,
     chat_id,
-    int(endtime.timestamp()),
-    target_user.id if target_user else 0,
+    start,
+    user_id,
+    '--top', TOP_WORDS,
   ]
   cmd = [str(x) for x in cmd]
   p = await asyncio.create_subprocess_exec(
@@ -50,28 +88,63 @@ async def generate_wordcloud(chat_id, chat_title, target_user, endtime, reply):
   for line in it:
     w, n = line.split(None, 1)
     words[w] = int(n)
-  st2 = time.time()
-  logger.info('分析完成，用时 %.3fs', st2 - st.timestamp())
+  return total_messages, words
+
+async def cutwords_via_socket(chat_id, start, user_id):
+  req = {
+    'group_id': chat_id,
+    'endtime': start,
+    'user_id': user_id or None,
+    'top': TOP_WORDS,
+  }
+  reader, writer = await asyncio.open_unix_connection(CUTWORDS_SOCKET)
+  try:
+    m = json.dumps(req).encode()
+    writer.write(struct.pack('>I', len(m)) + m)
+    await writer.drain()
+    size = struct.unpack('>I', await reader.readexactly(4))[0]
+    resp = json.loads(await reader.readexactly(size))
+  finally:
+    writer.close()
+
+  if error := resp.get('error'):
+    raise RuntimeError(f'luoxu-cutwords: {error}')
+  return resp['messages'], dict(resp['words'])
+
+async def generate_wordcloud(chat_id, chat_title, target_user, endtime, reply):
+  logger.info(
+    '生成词云，群组 %s，用户 %s, 结束时间 %s',
+    chat_title,
+    utils.get_display_name(target_user),
+    endtime.strftime('%Y-%m-%d %H:%M:%S%z'),
+  )
+  user_id = target_user.id if target_user else 0
+  # identical requests made around the same time share the counting and
+  # rendering (and their results, for a while)
+  start = int(endtime.timestamp()) // TIME_BUCKET * TIME_BUCKET
+  key = chat_id, user_id, start
+  total_messages, words, generated_at = await _counts.get_or_load(
+    key, partial(count_words, chat_id, start, user_id))
 
   if not words:
     await reply('落絮词云未找到符合条件的消息。')
     return
 
-  stream = io.BytesIO()
-  stream.name = 'wordcloud.png'
-  loop = asyncio.get_event_loop()
-  await loop.run_in_executor(None, gen_image, words, stream)
+  st2 = time.time()
+  png = await _images.get_or_load(key, partial(render, words))
   st3 = time.time()
   logger.info('生成完成，用时 %.3fs', st3 - st2)
 
-  stream.seek(0)
+  stream = io.BytesIO(png)
+  stream.name = 'wordcloud.png'
+  starttime = datetime.datetime.fromtimestamp(start, TIMEZONE)
   await reply(
     f'落絮词云为您生成消息词云\n'
     f'{chat_title} 群组 {utils.get_display_name(target_user)}\n'
-    f'从 {endtime:%Y-%m-%d %H:%M:%S}\n'
-    f'到 {st:%Y-%m-%d %H:%M:%S}\n'
+    f'从 {starttime:%Y-%m-%d %H:%M:%S}\n'
+    f'到 {generated_at:%Y-%m-%d %H:%M:%S}\n'
     f'共 {total_messages} 条消息',
-    file = (stream if words else None),
+    file = stream,
   )
   logger.info('回复完成，用时 %.3fs', time.time() - st3)
 
@@ -90,13 +163,23 @@ async def send_help(event):
     '项目源码： https://github.com/lilydjwg/luoxu/tree/master/luoxu_plugins/wordcloud',
     link_preview = False,
   )
+  # don't hold a worker of the plugin while waiting
+  _background(delete_later(help_message, 60))
 
-  await asyncio.sleep(60)
+async def delete_later(message, delay):
+  await asyncio.sleep(delay)
   try:
-    await help_message.delete()
+    await message.delete()
   except:
     logger.warn('删除帮助消息失败')
 
+_background_tasks = set()
+
+def _background(coro):
+  task = asyncio.create_task(coro)
+  _background_tasks.add(task)
+  task.add_done_callback(_background_tasks.discard)
+
 def parse_args(args):
   if not args or len(args) > 2:
     return None
@@ -144,6 +227,11 @@ async def wordcloud(event):
   )
 
 def register(indexer, client):
-  global DBSTRING
-  DBSTRING = indexer.config['plugin']['wordcloud']['url']
+  global DBSTRING, CUTWORDS_SOCKET, RENDER_WORKERS
+  config = indexer.config['plugin']['wordcloud']
+  DBSTRING = config['url']
+  CUTWORDS_SOCKET = config.get('cutwords_socket')
+  RENDER_WORKERS = config.get('render_workers', RENDER_WORKERS)
+  metrics.register_cache('wordcloud_counts', _counts)
+  metrics.register_cache('wordcloud_images', _images)
   indexer.add_msg_handler(wordcloud, pattern='/luoxucloud(?: .*)?')